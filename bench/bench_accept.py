@@ -0,0 +1,94 @@
+#!/bin/env python3
+"""
+Benchmark: accept-to-first-byte latency of txservice.py
+
+Starts txservice.py (process mode) once without and once with the pre-forked
+worker pool and measures for every connection the time from connect() until
+the first byte (the initial Acknowledge) arrives.
+
+usage: python3 bench/bench_accept.py [-n 50] [--pool 4] [--burst 1] [-m txServiceProvider_example]
+"""
+
+import os
+import sys
+import time
+import socket
+import statistics
+import subprocess
+from argparse import ArgumentParser
+
+OUR_PATH = os.path.dirname(os.path.realpath(__file__))
+TXSERVICE = os.path.join(OUR_PATH, '..', 'txservice.py')
+
+
+def free_port() -> int:
+	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+
+
+def first_byte(port:int) -> float:
+	'''Connect, wait for the first byte, hang up. Returns the latency in seconds'''
+	t0 = time.perf_counter()
+	with socket.create_connection(('127.0.0.1', port), timeout=10) as s:
+		s.recv(1)
+		t = time.perf_counter() - t0
+		s.sendall(bytes([3, 0]))   # End
+	return t
+
+
+def wait_ready(port:int, timeout=10):
+	t_end = time.monotonic() + timeout
+	while time.monotonic() < t_end:
+		try:
+			first_byte(port)
+			return
+		except OSError:
+			time.sleep(0.1)
+	raise RuntimeError('server did not start')
+
+
+def run(args, pool:int) -> list:
+	port = free_port()
+	cmd = [sys.executable, TXSERVICE, '-p', str(port), '--conn', str(max(50, args.burst*2)),
+		'--pool', str(pool), '-m', args.module, '-l', 'ERROR']
+	srv = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	try:
+		wait_ready(port)
+		times = []
+		for i in range(args.n):
+			time.sleep(args.pause)   # give the server time to replenish its pool
+			if args.burst > 1:
+				# connect a burst of callers at once
+				from concurrent.futures import ThreadPoolExecutor
+				with ThreadPoolExecutor(args.burst) as ex:
+					times.extend(ex.map(lambda _: first_byte(port), range(args.burst)))
+			else:
+				times.append(first_byte(port))
+		return times
+	finally:
+		srv.terminate()
+		srv.wait()
+
+
+def report(name:str, times:list):
+	ms = sorted(t*1000 for t in times)
+	p95 = ms[min(len(ms)-1, int(len(ms)*0.95))]
+	print(f"{name:<12} n={len(ms):<4} min={ms[0]:7.2f} median={statistics.median(ms):7.2f} p95={p95:7.2f} max={ms[-1]:7.2f} ms")
+
+
+def main():
+	parser = ArgumentParser(description='accept-to-first-byte latency of txservice.py with and without worker pool')
+	parser.add_argument('-n', dest='n', type=int, default=50, help='number of rounds')
+	parser.add_argument('--pool', dest='pool', type=int, default=4, help='size of the worker pool')
+	parser.add_argument('--burst', dest='burst', type=int, default=1, help='connections per round')
+	parser.add_argument('--pause', dest='pause', type=float, default=0.2, help='pause between rounds (s)')
+	parser.add_argument('-m', '--module', dest='module', default='txServiceProvider_example', help='provider module')
+	args = parser.parse_args()
+
+	report('no pool', run(args, 0))
+	report(f'pool={args.pool}', run(args, args.pool))
+
+
+if __name__ == '__main__':
+	main()
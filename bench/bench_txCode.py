@@ -0,0 +1,315 @@
+#!/bin/env python3
+"""
+Benchmark: throughput of the code conversion txCode.BaudotMurrayCode
+
+Measures encodeA2BM, decodeBM2A and do_flip_bits for every coding (ITA2, US,
+MKT2, ZUSE) and ascii_to_tty_text, in characters per second, on corpora like
+the ones the providers really send and receive.
+
+Every rate is the best of several runs of at least --min-time each, and is
+normalised by the rate of a fixed calibration loop whose runs take turns
+with the ones of the measurement, so a machine which is slower or busier
+at the moment doesn't look like a regression.
+Decoding and bit flipping of a corpus the coding mostly drops (Cyrillic in
+ITA2, …) are not measured, the few codes left are only noise.
+
+The results can be saved as JSON baseline and later runs checked against
+it: a normalised rate below baseline * (1 - threshold) is a regression
+(exit code 1).
+
+The baseline is the median of --runs complete runs; a key below the
+threshold in --check is measured again (--retries) before it counts.
+
+--equivalence only checks that the output is identical to the one of the
+implementation before the lookup tables (txCode_orig.py): encodeA2BM,
+decodeBM2A (every show_BuZi, in one piece, in chunks and of random codes),
+do_flip_bits and ascii_to_tty_text.
+
+usage: python3 bench/bench_txCode.py [--save] [--check] [--threshold 0.25] [--baseline FILE]
+       python3 bench/bench_txCode.py --equivalence
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import timeit
+from argparse import ArgumentParser
+
+OUR_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(OUR_PATH, '..'))
+import txCode
+
+BMC = txCode.BaudotMurrayCode
+BASELINE = os.path.join(OUR_PATH, 'baseline_txCode.json')
+TIMER = time.process_time   # CPU time: less noise from other processes than wall time
+
+CODINGS = {
+	'ITA2': BMC.CODING_ITA2,
+	'US': BMC.CODING_US,
+	'MKT2': BMC.CODING_MKT2,
+	'ZUSE': BMC.CODING_ZUSE,
+}
+
+
+def corpus_timetable() -> str:
+	'''Departure board as txServiceProvider_bahn prints it'''
+	deps = [
+		('07:12', '+2min', 'z', 'ice 597', 'muenchen hbf', '12'),
+		('07:15', '', 's', 's1', 'wiesbaden hbf', '103'),
+		('07:21', '+12min', 'z', 're 4', 'karlsruhe hbf', '9'),
+		('07:24', '', 'u', 'u4', 'enkheim', '2'),
+		('07:30', '+1min', 't', '11', 'fechenheim schiesshuettenstr.', '-'),
+		('07:33', '', 'b', '36', 'westbahnhof', 'c'),
+	]
+	lines = ['\r\nabfahrten von frankfurt (main) hbf, frankfurt\r\n          ab  24.12.2025 07:10 uhr\r\n\n',
+		'.zeit....art.linie.....ziel............................steig...i.\r\n']
+	for t, delay, kind, line, dest, track in deps:
+		s = (t + ' ' + delay + '      ')[:13] + '  ' + kind + ' ' + line + '          '
+		s = s[:22] + ' ' + dest[:30] + ' ' * 36
+		s = s[:59-len(track)-1] + ' ' + track
+		lines.append(s + '   (i)\r\n')
+	return ''.join(lines) * 40
+
+
+def corpus_figs() -> str:
+	'''Letters and figures mixed: every few characters a Bu/Zi switch'''
+	return ('ZUG 4711 AB 12.30 AN 14.05, GL. 7/8 (+5 MIN) = 2 UMST., KM 0-42? '
+		'TEL. 069/1234-56 NR. 3A/4B/5C. ') * 60
+
+
+def corpus_cyrillic() -> str:
+	'''Russian text for MKT2 (the other codings drop the characters)'''
+	return ('МОСКВА 12 ИЮНЯ. ПОЕЗД НОМЕР 7 ОТПРАВЛЯЕТСЯ С ПЕРВОГО ПУТИ В 14.30, '
+		'ПРИБЫТИЕ В САНКТ-ПЕТЕРБУРГ В 18.45. ЩИ, БОРЩ И ЧАЙ В ВАГОНЕ-РЕСТОРАНЕ. ') * 50
+
+
+def corpus_umlaut() -> str:
+	'''German input with umlauts, sharp s, typographic quotes and symbols'''
+	return ('Grüße aus Köln! Die Größenänderung der Büßerstraße kostet 5 € – „Übermäßig“, '
+		'sagt Jürgen Müßig & Söhne; Änderungen über Öffnungszeiten: siehe Aushang #3.\r\n') * 40
+
+
+CORPORA = {
+	'timetable': corpus_timetable(),
+	'figs': corpus_figs(),
+	'cyrillic': corpus_cyrillic(),
+	'umlaut': corpus_umlaut(),
+}
+
+
+def calibration_work(data=bytes(range(32)) * 16, lut={i: chr(0x40 + i) for i in range(32)}):
+	'''Fixed mix of what the codec does: dict lookups, joins, translate'''
+	ret = []
+	for b in data:
+		ret.append(lut.get(b, '?'))
+	''.join(ret).encode('latin-1').translate(bytes(range(255, -1, -1)))
+	return data.decode('latin-1').upper()
+
+
+def runs_for(func, min_time:float) -> int:
+	'''Number of calls of func which take at least min_time'''
+	number = 1
+	while timeit.Timer(func, timer=TIMER).timeit(number) < min_time:
+		number *= 2
+	return number
+
+
+def rate(func, chars:int, repeat:int, min_time:float) -> tuple:
+	'''
+	Characters per second of func and this rate normalised by the one of the
+	calibration loop: best of repeat runs of at least min_time each, func
+	and calibration in turns (both see the same state of the machine)
+	'''
+	number = runs_for(func, min_time)
+	cnumber = runs_for(calibration_work, min_time)
+	best = cbest = float('inf')
+	for i in range(repeat):
+		best = min(best, timeit.Timer(func, timer=TIMER).timeit(number))
+		cbest = min(cbest, timeit.Timer(calibration_work, timer=TIMER).timeit(cnumber))
+	chars_per_s = chars * number / best
+	return chars_per_s, chars_per_s / (cnumber / cbest)
+
+
+def measurements() -> dict:
+	'''key -> (function, characters per call) of everything measured'''
+	funcs = {}
+	for cname, text in CORPORA.items():
+		funcs[f'tty/{cname}'] = (lambda text=text: BMC.ascii_to_tty_text(text), len(text))
+		for coding, c in CODINGS.items():
+			bmc = BMC(False, c, False)
+			code = bytes(bmc.encodeA2BM(text))
+
+			def encode(bmc=bmc, text=text):
+				bmc._mode = None
+				bmc.encodeA2BM(text)
+			funcs[f'encode/{coding}/{cname}'] = (encode, len(text))
+			if len(code) < len(text) // 2:
+				continue   # the coding drops most of the corpus
+
+			def decode(bmc=bmc, code=code):
+				bmc._mode = None
+				return bmc.decodeBM2A(code)
+			funcs[f'decode/{coding}/{cname}'] = (decode, len(code))
+			funcs[f'flip/{coding}/{cname}'] = (lambda code=code: BMC.do_flip_bits(code), len(code))
+	return funcs
+
+
+def run(args, funcs:dict) -> tuple:
+	'''Rates (characters per second) and normalised rates of funcs'''
+	results = {}
+	normalised = {}
+	for key, (func, chars) in funcs.items():
+		results[key], normalised[key] = rate(func, chars, args.repeat, args.min_time)
+	return results, normalised
+
+
+def run_median(args, funcs:dict, runs:int) -> tuple:
+	'''Like run(), the median of runs complete runs per key (for the baseline)'''
+	all_runs = [run(args, funcs) for i in range(runs)]
+	results = {}
+	normalised = {}
+	for key in funcs:
+		results[key] = statistics.median(r[key] for r, n in all_runs)
+		normalised[key] = statistics.median(n[key] for r, n in all_runs)
+	return results, normalised
+
+
+def recheck(args, funcs:dict, results:dict, normalised:dict, baseline:dict):
+	'''Measure the keys below the threshold again (--retries times), the best counts: one slow moment of the machine is no regression'''
+	for i in range(args.retries):
+		slow = [key for key in results if key in baseline and normalised[key] / baseline[key] < 1 - args.threshold]
+		if not slow:
+			return
+		again = run(args, {key: funcs[key] for key in slow})
+		for key in slow:
+			if again[1][key] > normalised[key]:
+				results[key], normalised[key] = again[0][key], again[1][key]
+
+
+def equivalence() -> list:
+	'''
+	Compare txCode with the implementation before the lookup tables
+	(txCode_orig) on the corpora, in one piece and in chunks, and on random
+	codes: returns the differences
+	'''
+	import random
+	import txCode_orig
+	OBMC = txCode_orig.BaudotMurrayCode
+	rnd = random.Random(4711)
+	diffs = []
+
+	def compare(what, new, old):
+		if new != old:
+			diffs.append(what)
+			print(f"DIFFERENT {what}: {new[:60]!r} != {old[:60]!r}")
+
+	for cname, text in CORPORA.items():
+		compare(f'tty/{cname}', BMC.ascii_to_tty_text(text), OBMC.ascii_to_tty_text(text))
+		for coding, c in CODINGS.items():
+			for show in (0, 1, 2):
+				new, old = BMC(False, c, False, show_BuZi=show), OBMC(False, c, False, show_BuZi=show)
+				code = bytes(new.encodeA2BM(text))
+				compare(f'encode/{coding}/{cname}', code, bytes(old.encodeA2BM(text)))
+				compare(f'decode/{coding}/{cname}/show{show}', new.decodeBM2A(code), old.decodeBM2A(code))
+				compare(f'flip/{coding}/{cname}', bytes(BMC.do_flip_bits(code)), bytes(OBMC.do_flip_bits(code)))
+
+				# in chunks: the Bu/Zi mode goes on from chunk to chunk
+				new, old = BMC(False, c, False, show_BuZi=show), OBMC(False, c, False, show_BuZi=show)
+				n = 0
+				while n < len(text):
+					k = rnd.randint(1, 60)
+					compare(f'encode/{coding}/{cname}/chunk{n}', bytes(new.encodeA2BM(text[n:n+k])), bytes(old.encodeA2BM(text[n:n+k])))
+					n += k
+				n = 0
+				while n < len(code):
+					k = rnd.randint(1, 50)
+					compare(f'decode/{coding}/{cname}/show{show}/chunk{n}', new.decodeBM2A(code[n:n+k]), old.decodeBM2A(code[n:n+k]))
+					n += k
+
+	# random codes, switch codes and invalid ones (>= 0x20) included, from an unknown mode
+	for coding, c in CODINGS.items():
+		for show in (0, 1, 2):
+			new, old = BMC(False, c, False, show_BuZi=show), OBMC(False, c, False, show_BuZi=show)
+			for i in range(200):
+				code = bytes(rnd.choice(range(0x22)) for j in range(rnd.randint(1, 50)))
+				if i % 20 == 0:
+					new._mode = old._mode = None
+				compare(f'decode/{coding}/random{i}/show{show}', new.decodeBM2A(code), old.decodeBM2A(code))
+	return diffs
+
+
+def report(results:dict, normalised:dict, baseline:dict=None, threshold:float=0.25) -> list:
+	'''Print the results (and the ratio of the normalised rates to the baseline), returns the regressions'''
+	regressions = []
+	for key, value in results.items():
+		line = f"{key:<28} {value/1e3:12.1f} kchars/s"
+		if baseline and key in baseline:
+			ratio = normalised[key] / baseline[key]
+			line += f"   x{ratio:5.2f}"
+			if ratio < 1 - threshold:
+				line += '   REGRESSION'
+				regressions.append(key)
+		print(line)
+	return regressions
+
+
+def main():
+	parser = ArgumentParser(description='throughput of txCode.BaudotMurrayCode')
+	parser.add_argument('--baseline', dest='baseline', default=BASELINE, help='JSON file with the baseline')
+	parser.add_argument('--save', dest='save', action='store_true', help='store the results as new baseline')
+	parser.add_argument('--check', dest='check', action='store_true', help='compare with the baseline, exit code 1 on regression')
+	parser.add_argument('--threshold', dest='threshold', type=float, default=0.25, help='allowed slowdown against the baseline (0.25 = 25%%)')
+	parser.add_argument('--repeat', dest='repeat', type=int, default=7, help='runs per measurement (best is taken)')
+	parser.add_argument('--min-time', dest='min_time', type=float, default=0.02, help='minimal duration of a run (s)')
+	parser.add_argument('--equivalence', dest='equivalence', action='store_true', help='only compare the output with txCode_orig (before the lookup tables), exit code 1 on a difference')
+	parser.add_argument('--runs', dest='runs', type=int, default=3, help='with --save: complete runs, the median is stored')
+	parser.add_argument('--retries', dest='retries', type=int, default=2, help='with --check: measure regressed keys again this often')
+	args = parser.parse_args()
+
+	if args.equivalence:
+		diffs = equivalence()
+		if diffs:
+			print(f"{len(diffs)} difference(s) to txCode_orig")
+			sys.exit(1)
+		print('Output identical to txCode_orig')
+		return
+
+	baseline = None
+	if args.check:
+		with open(args.baseline) as f:
+			stored = json.load(f)
+		if stored.get('machine') != platform.machine() or stored.get('python') != platform.python_version():
+			print(f"Note: baseline from {stored.get('machine')} / Python {stored.get('python')}")
+		baseline = stored['normalised']
+
+	funcs = measurements()
+	if args.save:
+		results, normalised = run_median(args, funcs, args.runs)
+	else:
+		results, normalised = run(args, funcs)
+	if baseline:
+		recheck(args, funcs, results, normalised, baseline)
+	regressions = report(results, normalised, baseline, args.threshold)
+
+	if args.save:
+		with open(args.baseline, 'w') as f:
+			json.dump({
+				'date': time.strftime('%Y-%m-%d'),
+				'machine': platform.machine(),
+				'python': platform.python_version(),
+				'results': {k: round(v) for k, v in results.items()},
+				'normalised': {k: round(v, 4) for k, v in normalised.items()},
+			}, f, indent=1, sort_keys=True)
+			f.write('\n')
+		print(f"Baseline saved to {args.baseline}")
+
+	if regressions:
+		print(f"{len(regressions)} regression(s) against the baseline (threshold {args.threshold:.0%})")
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,383 @@
+#!/bin/env python3
+"""
+Load generator: simulated i-Telex teleprinters calling txservice.py
+
+Every client speaks the real protocol: Version and Direct Dial packet,
+Baudot data, Acknowledges with the printed characters of a printer
+emulated at --baud (50 Bd: 6.7 characters per second) and the answerback
+on WRU. It follows a script of prompts and answers: as soon as the prompt
+is printed, the answer is "typed" (one line), after the last step it hangs
+up with an End packet.
+
+Reported per round: accept latency (connect until the first packet of the
+server), time to the first character, reject rate and, if the server is
+local (--start or --pid), its CPU time and RSS per session.
+With --ramp the concurrency is raised step by step until rejects,
+queueing, errors or a too long time to the first character show that it
+can't be sustained any more.
+With --time-scale the emulated printers (and a started server) run that
+much faster than real time; the times are reported in real time.
+
+usage: python3 bench/loadgen.py --start [-c 10] [-n 10] [--conn 10] [-m txServiceProvider_example]
+       python3 bench/loadgen.py -p 134 --host 192.0.2.1 -c 5 --script dialogue.json
+       python3 bench/loadgen.py --start --conn 20 --ramp 5 --max 40
+
+A script is a JSON list of [prompt, answer] pairs, answer null: hang up.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import statistics
+import subprocess
+from argparse import ArgumentParser
+
+OUR_PATH = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(OUR_PATH, '..'))
+TXSERVICE = os.path.join(OUR_PATH, '..', 'txservice.py')
+
+import txCode
+import txsFrame
+import txServiceProvider_base as txss_base
+
+# for txServiceProvider_example
+DEFAULT_SCRIPT = [
+	['ASK: ', 'RYRYRYRYRY'],
+	['ASK: ', 'THE QUICK BROWN FOX 1234567890'],
+	['ASK: ', None],
+]
+
+TICK = 0.1          # printer emulation and Acknowledge check
+ACK_INTERVAL = 1.0  # Acknowledge while the printer runs
+
+
+class Session():
+	'''One call of a simulated teleprinter'''
+
+	def __init__(self, args, script:list):
+		self._args = args
+		self._script = list(script)
+		self._bmc = txCode.BaudotMurrayCode(False, False, True)
+		self._cps = args.baud / 7.5 * args.time_scale  # 7.5 bit per character (1 start, 5 data, 1.5 stop)
+		self._tick = TICK / args.time_scale
+		self.t_accept = None     # connect until the first packet
+		self.t_first_char = None # connect until the first Baudot data
+		self.duration = None
+		self.rejected = None     # reason of the Reject packet
+		self.queued = False      # got the banner of the admission queue
+		self.error = None
+		self.received = 0        # Baudot characters
+		self.steps = 0           # script steps done
+		self.script_len = len(script)
+		self._parser = txsFrame.FrameParser()
+		self._text = ''          # received since the last script step (decoded)
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		t0 = loop.time()
+		try:
+			reader, writer = await asyncio.wait_for(
+				asyncio.open_connection(self._args.host, self._args.port), self._args.timeout)
+		except (OSError, asyncio.TimeoutError) as e:
+			self.error = f'connect: {e!r}'
+			return self
+		try:
+			await self._dialogue(reader, writer, loop, t0)
+		except (OSError, asyncio.IncompleteReadError) as e:
+			# a Reject may have arrived before the connection was reset
+			try:
+				self._frames(writer, await asyncio.wait_for(reader.read(4096), TICK), loop.time() - t0)
+			except (OSError, asyncio.TimeoutError):
+				pass
+			if self.rejected is None:
+				self.error = repr(e)
+		finally:
+			self.duration = loop.time() - t0
+			writer.close()
+		return self
+
+	def _send_text(self, writer, text:str):
+		code = self._bmc.encodeA2BM(text)
+		for i in range(0, len(code), 50):
+			chunk = code[i:i+50]
+			writer.write(bytes([2, len(chunk)]) + chunk)
+
+	def _frames(self, writer, data:bytes, t:float) -> bool:
+		'''Handle the packets in data (received t after connect), True: the call is over'''
+		if self.t_accept is None:
+			self.t_accept = t
+		self._parser.feed(data)
+		for kind, frame in self._parser:
+			if kind == 2:
+				if self.t_first_char is None:
+					self.t_first_char = t
+				self.received += len(frame) - 2
+				chars = self._bmc.decodeBM2A(frame[2:])
+				self._text += chars
+				if '@' in chars:   # WRU: answerback
+					self._send_text(writer, '\r\n' + self._args.wru)
+				if not self.queued and self._args.banner and self._args.banner.upper() in self._text.upper():
+					self.queued = True
+			elif kind == 3:   # End
+				return True
+			elif kind == 4:   # Reject
+				self.rejected = bytes(frame[2:]).decode('ASCII', errors='replace').rstrip('\x00')
+				return True
+		return False
+
+	async def _dialogue(self, reader, writer, loop, t0):
+		version = b'loadgen'
+		writer.write(bytes([7, len(version)+1, 1]) + version)
+		writer.write(bytes([1, 1, txss_base.encode_ext_for_direct_dial(self._args.ext)]))
+
+		printed = 0.0        # Baudot characters printed by the emulated printer
+		t_print = loop.time()
+		t_ack = loop.time()
+		t_quiet = None       # script done: hang up when the printer has been idle for a while
+		deadline = t0 + self._args.timeout
+
+		while loop.time() < deadline:
+			try:
+				data = await asyncio.wait_for(reader.read(4096), self._tick)
+			except asyncio.TimeoutError:
+				data = None
+			if data == b'':
+				self.error = 'closed by server'
+				return
+			now = loop.time()
+			if data and self._frames(writer, data, now - t0):
+				return
+
+			# emulated printer
+			printed = min(self.received, printed + self._cps * (now - t_print))
+			t_print = now
+			if now - t_ack >= ACK_INTERVAL / self._args.time_scale and self.t_accept is not None:
+				writer.write(bytes([6, 1, int(printed) & 0xff]))
+				t_ack = now
+			idle = int(printed) >= self.received
+
+			# script: answer when the prompt has been printed
+			if self._script and idle:
+				prompt, answer = self._script[0]
+				if self._text.replace('<', '').replace('>', '').upper().endswith(prompt.upper()):
+					self._script.pop(0)
+					self.steps += 1
+					self._text = ''
+					if answer is None:
+						break
+					self._send_text(writer, answer + '\r\n')
+			elif not self._script:
+				if not idle or data:
+					t_quiet = None
+				elif t_quiet is None:
+					t_quiet = now
+				elif now - t_quiet > 1.0 / self._args.time_scale:
+					break
+			await writer.drain()
+		else:
+			self.error = 'timeout'
+			return
+
+		writer.write(bytes([3, 0]))   # End
+		await writer.drain()
+
+
+class ServerProbe():
+	'''CPU time and RSS of a local server process and its children (Linux /proc)'''
+
+	def __init__(self, pid:int):
+		self.pid = pid
+		self._tick = os.sysconf('SC_CLK_TCK')
+		self._page = os.sysconf('SC_PAGE_SIZE')
+
+	def _tree(self) -> list:
+		children = {}
+		for name in os.listdir('/proc'):
+			if not name.isdigit():
+				continue
+			try:
+				with open(f'/proc/{name}/stat') as f:
+					ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+			except (OSError, IndexError, ValueError):
+				continue
+			children.setdefault(ppid, []).append(int(name))
+		pids, todo = [], [self.pid]
+		while todo:
+			pid = todo.pop()
+			pids.append(pid)
+			todo.extend(children.get(pid, []))
+		return pids
+
+	def sample(self) -> tuple:
+		'''(CPU seconds of the tree incl. ended children, RSS bytes of the tree)'''
+		cpu = 0
+		rss = 0
+		for pid in self._tree():
+			try:
+				with open(f'/proc/{pid}/stat') as f:
+					fields = f.read().rsplit(')', 1)[1].split()
+			except OSError:
+				continue
+			utime, stime, cutime, cstime = (int(x) for x in fields[11:15])
+			cpu += utime + stime + (cutime + cstime if pid == self.pid else 0)
+			rss += int(fields[21]) * self._page
+		return cpu / self._tick, rss
+
+
+async def run_round(args, script:list, concurrency:int, total:int, probe:ServerProbe=None) -> dict:
+	'''total sessions, concurrency at once'''
+	sessions = []
+	pending = list(range(total))
+	peak_rss = 0
+
+	async def client():
+		while pending:
+			pending.pop()
+			sessions.append(await Session(args, script).run())
+
+	async def sampler():
+		nonlocal peak_rss
+		while True:
+			peak_rss = max(peak_rss, probe.sample()[1])
+			await asyncio.sleep(0.2)
+
+	before = probe.sample() if probe else None
+	sampling = asyncio.ensure_future(sampler()) if probe else None
+	t0 = time.monotonic()
+	await asyncio.gather(*(client() for i in range(concurrency)))
+	wall = time.monotonic() - t0
+	result = {'concurrency': concurrency, 'sessions': sessions, 'wall': wall}
+	if probe:
+		sampling.cancel()
+		after = probe.sample()
+		result['cpu_per_session'] = (after[0] - before[0]) / max(1, len(sessions))
+		result['rss_per_session'] = max(0, max(peak_rss, after[1]) - before[1]) / concurrency
+		result['rss'] = max(peak_rss, after[1])
+	return result
+
+
+def ms(values:list) -> str:
+	if not values:
+		return '-'
+	v = sorted(x * 1000 for x in values)
+	p95 = v[min(len(v)-1, int(len(v)*0.95))]
+	return f"median {statistics.median(v):7.1f} p95 {p95:7.1f} max {v[-1]:7.1f} ms"
+
+
+def report(result:dict) -> dict:
+	s = result['sessions']
+	accept = [x.t_accept for x in s if x.t_accept is not None]
+	first = [x.t_first_char for x in s if x.t_first_char is not None]
+	rejected = [x for x in s if x.rejected is not None]
+	errors = [x for x in s if x.error is not None]
+	done = [x for x in s if x.steps == x.script_len]
+	queued = [x for x in s if x.queued]
+	reasons = {}
+	for x in rejected:
+		reasons[x.rejected] = reasons.get(x.rejected, 0) + 1
+
+	print(f"concurrency {result['concurrency']}: {len(s)} sessions in {result['wall']:.1f} s")
+	print(f"  script completed  {len(done)}/{len(s)}")
+	print(f"  accept latency    {ms(accept)}")
+	print(f"  first character   {ms(first)}")
+	print(f"  rejected          {len(rejected)}/{len(s)} ({100*len(rejected)/max(1, len(s)):.0f}%) {reasons or ''}")
+	print(f"  queued            {len(queued)}/{len(s)}")
+	if errors:
+		print(f"  errors            {len(errors)}: {errors[0].error}")
+	if 'cpu_per_session' in result:
+		print(f"  server CPU        {result['cpu_per_session']*1000:.1f} ms/session, "
+			f"RSS {result['rss']/2**20:.1f} MiB ({result['rss_per_session']/2**10:.0f} KiB/session)")
+	return {
+		'rejected': len(rejected),
+		'errors': len(errors),
+		'queued': len(queued),
+		'p95_first_char': sorted(first)[min(len(first)-1, int(len(first)*0.95))] if first else None,
+	}
+
+
+def free_port() -> int:
+	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+
+
+def start_server(args) -> subprocess.Popen:
+	args.host = '127.0.0.1'
+	args.port = free_port()
+	cmd = [sys.executable, TXSERVICE, '-p', str(args.port), '--conn', str(args.conn),
+		'-m', args.module, '--mode', args.mode, '--time-scale', str(args.time_scale), '-l', 'ERROR']
+	srv = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	t_end = time.monotonic() + 10
+	while time.monotonic() < t_end:
+		try:
+			socket.create_connection((args.host, args.port), timeout=1).close()
+			time.sleep(0.5)   # let the probe connection end
+			return srv
+		except OSError:
+			time.sleep(0.1)
+	srv.terminate()
+	raise RuntimeError('server did not start')
+
+
+async def amain(args, script:list, probe:ServerProbe):
+	if not args.ramp:
+		report(await run_round(args, script, args.c, args.n or args.c, probe))
+		return
+
+	sustained = 0
+	c = args.ramp
+	while c <= args.max:
+		r = report(await run_round(args, script, c, c, probe))
+		if r['rejected'] or r['errors'] or r['queued'] or r['p95_first_char'] is None or r['p95_first_char'] > args.max_first_char:
+			break
+		sustained = c
+		c += args.ramp
+	print(f"max sustainable concurrency: {sustained}" + (f" (maxConcurrent {args.conn})" if args.start else ''))
+
+
+def main():
+	parser = ArgumentParser(description='simulated i-Telex teleprinters calling txservice.py')
+	parser.add_argument('--host', dest='host', default='127.0.0.1', help='server address')
+	parser.add_argument('-p', '--port', dest='port', type=int, default=134, help='server port')
+	parser.add_argument('--start', dest='start', action='store_true', help='start txservice.py on a free local port')
+	parser.add_argument('--conn', dest='conn', type=int, default=10, help='maxConcurrent of the started server')
+	parser.add_argument('-m', '--module', dest='module', default='txServiceProvider_example', help='provider module of the started server')
+	parser.add_argument('--mode', dest='mode', default='process', help='mode of the started server (process, async)')
+	parser.add_argument('--pid', dest='pid', type=int, help='pid of a running local server (CPU and RSS)')
+	parser.add_argument('-c', dest='c', type=int, default=10, help='concurrent clients')
+	parser.add_argument('-n', dest='n', type=int, help='sessions in total (default: one per client)')
+	parser.add_argument('--ext', dest='ext', default=None, help='direct dial extension')
+	parser.add_argument('--baud', dest='baud', type=float, default=50, help='print rate of the emulated teleprinter')
+	parser.add_argument('--time-scale', dest='time_scale', type=float, default=1,
+		help='time runs that much faster (the started server gets the same --time-scale)')
+	parser.add_argument('--wru', dest='wru', default='12345 loadgen d', help='answerback')
+	parser.add_argument('--banner', dest='banner', default='bitte warten', help='queueBanner of the server (detects queueing)')
+	parser.add_argument('--script', dest='script', help='JSON file with [prompt, answer] pairs')
+	parser.add_argument('--timeout', dest='timeout', type=float, default=120, help='limit of a session (s)')
+	parser.add_argument('--ramp', dest='ramp', type=int, default=0, help='raise the concurrency in steps of RAMP')
+	parser.add_argument('--max', dest='max', type=int, default=100, help='highest concurrency of the ramp')
+	parser.add_argument('--max-first-char', dest='max_first_char', type=float, default=2.0,
+		help='sustainable: p95 time to the first character below this (s)')
+	args = parser.parse_args()
+
+	script = DEFAULT_SCRIPT
+	if args.script:
+		with open(args.script) as f:
+			script = json.load(f)
+
+	srv = start_server(args) if args.start else None
+	pid = srv.pid if srv else args.pid
+	probe = ServerProbe(pid) if pid and os.path.isdir('/proc') else None
+	try:
+		asyncio.run(amain(args, script, probe))
+	finally:
+		if srv:
+			srv.terminate()
+			srv.wait()
+
+
+if __name__ == '__main__':
+	main()
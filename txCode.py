@@ -9,6 +9,8 @@ __copyright__   = "Copyright 2020, JK"
 __license__     = "GPL3"
 __version__     = "0.1.0"
 
+import collections
+import re
 import time
 import unicodedata
 #from unidecode import unidecode
@@ -106,55 +108,43 @@ class BaudotMurrayCode:
 
         Ensure that text is an iterable containing already-decoded Python
         strings, not bytes.
-        """
-        ret = ''
 
-        text = text.upper()
+        One str.translate with a table of all ASCII/Latin-1 characters, other
+        characters are looked up once and cached (_TTYTable).
+        """
+        return text.upper().translate(_tty_table)
 
-        for a in text:
-            try:
+    @staticmethod
+    def tty_char(a:str) -> str:
+        """
+        Teleprinter replacement of one (upper case) character
+        """
+        if a not in BaudotMurrayCode._valid_ASCII_convert_chars:
+            if a in BaudotMurrayCode._LUT_convert_chars:
+                a = BaudotMurrayCode._LUT_convert_chars.get(a, '?')
+            else:
+                nkfd_norm = unicodedata.normalize('NFKD', a)
+                a =  u"".join([c for c in nkfd_norm if not unicodedata.combining(c)])
+                #a = unicodedata.normalize('NFD', a).encode('ascii', 'ignore')
+                #a = unidecode(a)
                 if a not in BaudotMurrayCode._valid_ASCII_convert_chars:
-                    if a in BaudotMurrayCode._LUT_convert_chars:
-                        a = BaudotMurrayCode._LUT_convert_chars.get(a, '?')
-                    else:
-                        nkfd_norm = unicodedata.normalize('NFKD', a)
-                        a =  u"".join([c for c in nkfd_norm if not unicodedata.combining(c)])
-                        #a = unicodedata.normalize('NFD', a).encode('ascii', 'ignore')
-                        #a = unidecode(a)
-                        if a not in BaudotMurrayCode._valid_ASCII_convert_chars:
-                            a = '?'
-                ret += a
-            except:
-                pass
-
-        return ret
+                    a = '?'
+        return a
 
     # -----
 
+    # bit order of the 5 code bits reversed (higher bits dropped)
+    _LUT_flip = bytes(int('{:05b}'.format(b & 0x1F)[::-1], 2) for b in range(256))
+
     @staticmethod
     def do_flip_bits(code: bytes) -> bytes:
-        ret = bytearray()
-
-        for b in code:
-            rb = 0
-            if b & 1:
-                rb |= 16
-            if b & 2:
-                rb |= 8
-            if b & 4:
-                rb |= 4
-            if b & 8:
-                rb |= 2
-            if b & 16:
-                rb |= 1
-            ret.append(rb)
-
-        return ret
+        return bytearray(code).translate(BaudotMurrayCode._LUT_flip)
 
     # =====
 
-    def __init__(self, loop_back:bool=False, coding:int=0, flip_bits=False, character_duration=0.15, show_BuZi:int=2):
+    def __init__(self, loop_back:bool=False, coding:int=0, flip_bits=False, character_duration=0.15, show_BuZi:int=2, clock=time):
         self._mode = None   # 0=LTRS 1=FIGS
+        self._clock = clock   # anything with monotonic(), for the loop-back timing
         self._flip_bits = flip_bits
         self._loop_back = loop_back
         self._show_BuZi = show_BuZi
@@ -173,7 +163,37 @@ class BaudotMurrayCode:
         else:
             self._LUT_BM2A = self._LUT_BM2A_ITA2
             self._LUT_BMsw = self._LUT_BMsw_ITA2
+        self._LUT_mode = {b: m for m, b in reversed(list(enumerate(self._LUT_BMsw)))}   # switch code -> mode
+        self._LUT_A2BM = self._lut_a2bm(self._LUT_BM2A, self._LUT_BMsw)
+        self._LUT_BM2A_tr = tuple(str.maketrans(dict(enumerate(layer))) for layer in self._LUT_BM2A)
+        self._RE_BM_special = re.compile(b'[' + re.escape(bytes(self._LUT_mode) + bytes(range(0x20, 0x100))) + b']')
+
+    # -----
 
+    # per coding, for each mode: dict character -> (codes, new mode), regex
+    # matching a run of characters with one code in this mode and the
+    # str.translate table of such a run (code as character). Other
+    # characters are added to the dict on first use, up to LUT_A2BM_MAX.
+    _LUTs_A2BM = {}
+    LUT_A2BM_MAX = 4096
+
+    def _lut_a2bm(self, layers:tuple, switch:tuple) -> tuple:
+        key = (layers, switch)
+        if key not in self._LUTs_A2BM:
+            chars = set(''.join(layers))
+            chars |= {c.lower() for c in chars if len(c.lower()) == 1 and c.lower().upper() == c}
+            luts, runs, codes = [], [], []
+            for mode in range(len(layers)):
+                lut = {}
+                for c in chars:
+                    code, nm = self._encode_char(c.upper(), mode)
+                    lut[c] = (bytes(code), nm)
+                same = {c: chr(code[0]) for c, (code, nm) in lut.items() if len(code) == 1 and nm == mode}
+                luts.append(lut)
+                runs.append(re.compile('[' + re.escape(''.join(sorted(same))) + ']*'))
+                codes.append(str.maketrans(same))
+            self._LUTs_A2BM[key] = (tuple(luts), tuple(runs), tuple(codes))
+        return self._LUTs_A2BM[key]
     # -----
 
     def reset(self):
@@ -183,46 +203,56 @@ class BaudotMurrayCode:
 
     def encodeA2BM(self, ascii:str) -> bytes:
         ''' convert an ASCII string to a list of baudot-murray-coded bytes '''
-        ret = bytearray()
-
         if not isinstance(ascii, str):
             ascii = str(ascii)
 
-        ascii = ascii.upper()
-
-        if self._mode is None:
-            self._mode = 0  # letters
-            ret.append(self._LUT_BMsw[self._mode])
-
-        for a in ascii:
-            try:  # symbol in current layer?
-                nm = self._mode
-                b = self._LUT_BM2A[nm].index(a)
-                ret.append(b)
-                if b in self._LUT_BMsw:  # explicit Bu or Zi
-                    self._mode = self._LUT_BMsw.index(b)
-            except ValueError:
-                try:  # symbol in other layer?
-                    nm += 1
-                    if nm >= len(self._LUT_BM2A):
-                        nm = 0
-                    b = self._LUT_BM2A[nm].index(a)
-                    ret.append(self._LUT_BMsw[nm])
-                    ret.append(b)
-                    self._mode = nm
-                except ValueError:
-                    try:  # symbol in other layer?
-                        nm += 1
-                        if nm >= len(self._LUT_BM2A):
-                            nm = 0
-                        b = self._LUT_BM2A[nm].index(a)
-                        ret.append(self._LUT_BMsw[nm])
-                        ret.append(b)
-                        self._mode = nm
-                    except:  # symbol not found -> ignore
-                        pass
-            except:  # unknown -> ignore
-                pass
+        return self.encode_chunk(ascii)[0]
+
+    # -----
+
+    def encode_chunk(self, ascii:str, budget:int=None) -> tuple:
+        '''
+        convert the start of an ASCII string to baudot-murray-coded bytes, not
+        more than budget bytes (None: no limit); returns the bytes and the
+        count of characters consumed. A character is never split from its
+        Bu/Zi switch code, the mode is kept for the next chunk.
+        '''
+        ret = bytearray()
+        if budget is None:
+            budget = len(ascii) * 6 + 1   # upper() gives up to 3 characters, each with switch code
+
+        mode = self._mode
+        if mode is None:
+            if budget < 1:
+                return ret, 0
+            mode = 0  # letters
+            ret.append(self._LUT_BMsw[mode])
+
+        n = 0
+        lut, runs, codes = self._LUT_A2BM
+        while n < len(ascii):
+            # run of characters of the current layer: one code each, translated in one go
+            k = min(runs[mode].match(ascii, n).end() - n, budget - len(ret))
+            if k:
+                ret += ascii[n:n+k].translate(codes[mode]).encode('latin-1')
+                n += k
+                if n == len(ascii):
+                    break
+            # character with Bu/Zi switch (or not in any layer)
+            a = ascii[n]
+            e = lut[mode].get(a)
+            if e is None:   # upper() may give more characters, else it is ignored
+                code, nm = self._encode_char(a.upper(), mode)
+                e = (bytes(code), nm)
+                if len(lut[mode]) < self.LUT_A2BM_MAX:
+                    lut[mode][a] = e
+            code, nm = e
+            if len(ret) + len(code) > budget:
+                break
+            ret += code
+            mode = nm
+            n += 1
+        self._mode = mode
 
         if ret and self._flip_bits:
             ret = self.do_flip_bits(ret)
@@ -230,54 +260,117 @@ class BaudotMurrayCode:
         if self._loop_back:
             length  = len(ret)
             self._loop_back_eat_bytes += length
-            time_act = time.monotonic()
+            time_act = self._clock.monotonic()
             if self._loop_back_expire_time < time_act:
                 self._loop_back_expire_time = time_act
             self._loop_back_expire_time += length * self._character_duration
 
-        return ret
+        return ret, n
+
+    # -----
+
+    def _encode_char(self, chars:str, mode:int) -> tuple:
+        ''' codes of the (upper case) characters of one input character and the new mode '''
+        code = bytearray()
+        layers = len(self._LUT_BM2A)
+        for a in chars:
+            for i in range(layers):   # symbol in current layer, then in the other ones
+                nm = (mode + i) % layers
+                b = self._LUT_BM2A[nm].find(a)
+                if b < 0:
+                    continue
+                if i:
+                    code.append(self._LUT_BMsw[nm])
+                    mode = nm
+                elif b in self._LUT_mode:  # explicit Bu or Zi
+                    mode = self._LUT_mode[b]
+                code.append(b)
+                break
+            # symbol not found -> ignore
+        return code, mode
 
     # -----
 
     def decodeBM2A(self, code:bytes) -> str:
         ''' convert a list/bytearray of baudot-murray-coded bytes to an ASCII string '''
-        ret = ''
+        ret = []
 
         if self._flip_bits:
             code = self.do_flip_bits(code)
+        code = bytes(code)
 
-        for b in code:
-            if self._loop_back and self._loop_back_eat_bytes:
-                if time.monotonic()-self._loop_back_expire_time > 6:   # about 40 characters
+        if self._loop_back and self._loop_back_eat_bytes:
+            n = 0
+            while n < len(code) and self._loop_back_eat_bytes:
+                if self._clock.monotonic()-self._loop_back_expire_time > 6:   # about 40 characters
                     self._loop_back_eat_bytes = 0
                 else:
                     self._loop_back_eat_bytes -= 1
-                    #if b == 2:
-                    #    print(self._loop_back_eat_bytes, time.monotonic()-self._loop_back_expire_time)   # debug
-                    continue
-
-            try:
-                if b in self._LUT_BMsw:
-                    mode = self._LUT_BMsw.index(b)
-                    if self._mode != mode:
-                        self._mode = mode
-                        if self._show_BuZi == 0: # no BuZi
-                            continue
-                    if self._show_BuZi <= 1: # explicit BuZi
+                    n += 1
+            code = code[n:]
+
+        # every code decoded in every layer, the runs between the Bu/Zi
+        # switches (and invalid codes) are cut out of the layer in use
+        layers = [code.decode('latin-1').translate(tr) for tr in self._LUT_BM2A_tr]
+        switch = self._LUT_mode
+        pos = 0
+        for m in self._RE_BM_special.finditer(code):
+            i = m.start()
+            if i > pos:
+                if self._mode is None:
+                    self._decode_unknown(ret, code[pos:i])
+                else:
+                    ret.append(layers[self._mode][pos:i])
+            pos = i + 1
+            b = code[i]
+
+            mode = switch.get(b)
+            if mode is not None:
+                if self._mode != mode:
+                    self._mode = mode
+                    if self._show_BuZi == 0: # no BuZi
                         continue
+                if self._show_BuZi <= 1: # explicit BuZi
+                    continue
+                ret.append(self._LUT_BM2A[self._mode][b])
+            else:
+                ret.append('{?#' + hex(b)[2:] + '}')
+        if pos < len(code):
+            if self._mode is None:
+                self._decode_unknown(ret, code[pos:])
+            else:
+                ret.append(layers[self._mode][pos:])
+
+        return ''.join(ret)
+
+    def _decode_unknown(self, ret:list, code:bytes):
+        ''' codes received before the first Bu/Zi: both possibilities '''
+        for b in code:
+            ret.append('{?' + self._LUT_BM2A[0][b] + self._LUT_BM2A[1][b] + '}')
 
-                if b >= 0x20:
-                    ret += '{?#' + hex(b)[2:] + '}'
-                elif self._mode is None:
-                    ret += '{?'
-                    ret += self._LUT_BM2A[0][b]
-                    ret += self._LUT_BM2A[1][b]
-                    ret += '}'
-                else:
-                    ret += self._LUT_BM2A[self._mode][b]
-            except:
-                ret += '{!}'  # debug
+#######
 
-        return ret
+# translation table of ascii_to_tty_text: ASCII/Latin-1 precomputed, other
+# characters are added on first use, not more than TTY_CACHE_SIZE of them
+# (the oldest goes first: hits are plain dict lookups of str.translate, they
+# aren't tracked)
+TTY_CACHE_SIZE = 1024
+
+class _TTYTable(dict):
+    def __init__(self, size:int):
+        super().__init__((c, BaudotMurrayCode.tty_char(chr(c))) for c in range(256))
+        self._size = size
+        self._cached = collections.OrderedDict()
+
+    def __missing__(self, c:int) -> str:
+        a = BaudotMurrayCode.tty_char(chr(c))
+        self[c] = a
+        self._cached[c] = None
+        if len(self._cached) > self._size:
+            old, _ = self._cached.popitem(last=False)
+            self.pop(old, None)
+        return a
+
+_tty_table = _TTYTable(TTY_CACHE_SIZE)
 
 #######
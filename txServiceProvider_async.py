@@ -0,0 +1,204 @@
+#!/bin/env python3
+"""
+Telex Service Provider Base for asyncio
+Like TelexServiceProvider_base, but doHandleClient() is a coroutine and
+the input/output methods are awaited:
+
+	async def doHandleClient(self):
+		await self.send('\r\nWelcome.\r\n')
+		while self.is_running():
+			s = await self.getInput('Ask')
+
+A waiting session is only a suspended coroutine, in the asyncio core
+(mode=async) it needs no thread. In process mode the provider runs on an
+event loop of its own in the process of the connection.
+
+Blocking calls (e.g. HTTP requests) must not run on the event loop:
+	r = await self.run_blocking(requests.get, url, params=p)
+"""
+
+import asyncio
+import functools
+
+import logging
+l = logging.getLogger("txs." + __name__)
+
+import txServiceProvider_base as txss_base
+import txsWRU
+from txServiceProvider_base import TelexServiceProvider_base, TelexConnClosed
+
+
+class TelexServiceProvider_async(TelexServiceProvider_base):
+	is_async = True
+
+###########################################################################################
+
+	async def send(self, s: str, block: bool = True) -> int:
+		'''
+		Queue s for sending, returns the count of characters taken. Waits
+		while the output buffer is above its high watermark, unless block is
+		False: then only as much as fits is taken.
+		'''
+		if not block:
+			return self._tx_buffer.put(s, False)
+		done = 0
+		while done < len(s) and await self._wait_until(lambda: not self._tx_buffer.throttled):
+			n = self._tx_buffer.put(s[done:], False)
+			if not n:
+				break
+			done += n
+		return done
+
+	async def requestWRU(self, cached: bool = True) -> str:
+		owru = self._cachedWRU() if cached else None
+		if owru is not None:
+			return owru
+
+		# the protocol side takes the answerback out of the received characters,
+		# wait until it is complete (WRU_THRES after its last character at the latest)
+		wru = self._wru = txsWRU.Answerback(txss_base.WRU_THRES)
+		wru.on_change = self._changed_threadsafe
+		if self._rx_buffer.closed:
+			wru.close()
+		await self.send('@')
+		while not wru.done and not wru.closed:
+			count = wru.count
+			wait = wru.deadline(None)
+			if wait is not None:
+				wait = wait - self.clock.monotonic()
+				if wait <= 0:
+					break
+			await self._wait_until(lambda: wru.done or wru.closed or wru.count != count,
+				self.clock.timeout(wait))
+		wru.finish()
+		return self._receivedWRU()
+
+	async def recvChar(self, returnWRU = False) -> str:
+		# wait until new char arrives (or the connection is closed)
+		if not await self._wait_until(lambda: self._rx_buffer):
+			raise TelexConnClosed()
+		c = self._rx_buffer.get_nowait()
+		if c in ['<','>']:
+			self._BuZi = c
+		if (c == '@'):
+			if not self.ignoreWRU:
+				await self.send('\r\n'+self.WRU)
+			if not returnWRU:
+				return ''
+		return c.lower()
+
+	async def recvUntil(self, stop) -> [str, str]:
+		ast = ''
+		c = ''
+		while not c in stop:
+			c = await self.recvChar()
+			if c == '<' or c == '>':
+				continue
+			ast += c
+		return ast, c
+
+	async def recvLine(self) -> str:
+		s,e = await self.recvUntil(['\n'])
+		return s
+
+	async def recvCorrLine(self, cancelStr = 'xxx', onlyAtEnd = True) -> str:
+		s,e = await self.recvUntil(['\n'])
+		return self._corrLine(s, cancelStr, onlyAtEnd)
+
+	async def recvFile(self, stop = '(eof)') -> str:
+		ast = ''
+		tmp = ''
+
+		while tmp != stop:
+			c = await self.recvChar()
+			if c == '<' or c == '>':
+				continue
+			tmp += c
+			if not (stop.startswith(tmp)):
+				ast += tmp
+				tmp = ''
+		return ast
+
+	async def getInput(self, prompt = '', end = ': '):
+		inp = ''
+		while inp == '':
+			if len(prompt) > 0:
+				await self.send(prompt+end)
+			await self.send(self._BuZi)
+			inp = (await self.recvCorrLine()).strip()
+			await self.send('\r')
+		return inp
+
+	async def getInputOption(self, validOptions, prompt = '', end = ': '):
+		opt = ''
+		while (opt == '' or not opt in validOptions):
+			if len(prompt) > 0:
+				await self.send(prompt+end)
+			await self.send(self._BuZi)
+			opt = (await self.recvCorrLine()).strip()
+
+			opt = self._validOptionStartsWith(opt, validOptions)
+
+			await self.send('\r')
+		return opt
+
+	async def run_blocking(self, func, *args, **kwargs):
+		'''Run a blocking function in a worker thread and return its result'''
+		return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+###########################################################################################
+
+	async def _wait_until(self, predicate, timeout=None) -> bool:
+		'''Wait until predicate() is true, False on timeout (real seconds) or if the connection is closed'''
+		loop = asyncio.get_running_loop()
+		deadline = None if timeout is None else loop.time() + timeout
+		while True:
+			self._changed.clear()
+			if predicate():
+				return True
+			if self._rx_buffer.closed:
+				return False
+			wait = None if deadline is None else deadline - loop.time()
+			if wait is not None and wait <= 0:
+				return False
+			try:
+				await asyncio.wait_for(self._changed.wait(), wait)
+			except asyncio.TimeoutError:
+				return bool(predicate())
+
+	# in process mode: the provider gets an event loop of its own
+	def run_provider(self):
+		asyncio.run(self.run_provider_async())
+
+	# runs the actual program of the service
+	# (as task of the asyncio core, see txsAsync)
+	async def run_provider_async(self):
+		# the channels wake us up, whichever thread changes them
+		loop = asyncio.get_running_loop()
+		self._changed = asyncio.Event()
+
+		def changed():
+			try:
+				loop.call_soon_threadsafe(self._changed.set)
+			except RuntimeError:   # loop closed, the provider is over
+				pass
+		self._changed_threadsafe = changed
+		self._rx_buffer.on_data = self._rx_buffer.on_close = changed
+		self._tx_buffer.on_low = self._tx_buffer.on_empty = self._tx_buffer.on_close = changed
+		try:
+			# now do what to do
+			await self.doHandleClient()
+		except TelexConnClosed:
+			l.info('Conn closed while reading.')
+		except Exception:
+			# catch any possible exception so we can come to an end cleanly.
+			l.debug('Provider ended by exception', exc_info=True)
+		finally:
+			# wait to flush the _tx_buffer (if connection still there)
+			await self._wait_until(lambda: not self._tx_buffer)
+			self._rx_buffer.on_data = self._rx_buffer.on_close = None
+			self._tx_buffer.on_low = self._tx_buffer.on_empty = self._tx_buffer.on_close = None
+
+	# just for deriving purpose
+	async def doHandleClient(self):
+		await self.send('\r\nasync service provider base class. not meant to be called.\r\n')
@@ -1331,14 +1331,26 @@ class TelexServiceProvider(TxSP_base):
 		
 		self.send('\r\n\n')
 		
+		self._ctn = 0
+		self.menuMain()
+
+	# the main menu is a hibernation point: while the caller chooses, the
+	# session can be parked (async mode), see TelexServiceProvider_base.hibernate
+	def doResume(self, step:str):
+		if step == 'main':
+			self.menuMain(prompted=True)
+
+	def menuMain(self, prompted=False):
 		mode = ''
-		ctn = 0
 		while mode != 'x':
-			self.send('a = abfahrtstafel. v = verbindung suchen.')
-			if ctn > 0:
-				self.send('\r\nvo = verbindung suchen, optionen behalten.')
-			self.send(' x = trennen.\r\n')
-			if ctn == 0:
+			if not prompted:
+				self.send('a = abfahrtstafel. v = verbindung suchen.')
+				if self._ctn > 0:
+					self.send('\r\nvo = verbindung suchen, optionen behalten.')
+				self.send(' x = trennen.\r\n')
+				self.hibernate('main')
+			prompted = False
+			if self._ctn == 0:
 				mode = self.getInputOption(['a','v','x'])
 			else:
 				mode = self.getInputOption(['a','v','vo','x'])
@@ -1349,7 +1361,7 @@ class TelexServiceProvider(TxSP_base):
 				if mode == 'v':
 					self.initOptions()
 					self.menuDoVerbindung()
-					ctn += 1
+					self._ctn += 1
 				if mode == 'vo':
 					self.menuDoVerbindung()
 			except:
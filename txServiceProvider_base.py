@@ -8,21 +8,33 @@ This handles the connection to a client in two ways:
 
 import sys
 import time
-from threading import Thread
+from threading import Thread, Lock
 import socket
+import selectors
 from txsReleaseInfo import ReleaseInfo
 
 import logging
 l = logging.getLogger("txs." + __name__)
 
 import txCode
-
-WRU_THRES = 1
+import txsFrame
+import txsFlow
+import txsClock
+import txsWRU
+from txsChannel import Channel
+
+WRU_THRES = 1        # seconds (clock) after the last character, an answerback without end of line is complete
+TICK = 0.2           # pacing of the sending and socket timeout, seconds of the clock
+ACK_INTERVAL = 1.0   # Acknowledge of a Baudot connection, seconds of the clock
+STOP_POLL = 1.0      # real seconds: the threaded protocol loop checks the stop event at least this often
+DIAL_TIMEOUT = 2.0   # seconds to wait for the Direct Dial packet before the default provider is chosen
+WAIT_RECEIVE = 4096  # bytes kept of a caller which isn't served yet (admission queue, Direct Dial)
 
 # i-Telex allowed package types for Baudot texting mode
 # (everything else triggers ASCII texting mode)
 from itertools import chain
 allowed_types = lambda: chain(range(0x00, 0x09+1), range(0x10, 0x1f+1))
+_allowed_types = frozenset(allowed_types())
 
 #######
 
@@ -83,12 +95,93 @@ def encode_ext_for_direct_dial(ext:str) -> int:
         l.warning("Invalid direct dial extension: {!r} (falling back to none)".format(ext))
         return 0
 
+def parse_direct_dial(data:bytes) -> (bool, str):
+	"""
+	Look for the Direct Dial packet at the start of a connection (before the
+	provider is chosen, see txservice routing). Returns (decided, extension);
+	decided is False as long as more data is needed. A connection which
+	starts with anything but Heartbeat, Version or telnet sequences has
+	dialled no extension.
+	"""
+	pos = 0
+	while pos < len(data):
+		if data[pos] == 255:   # Telnet control sequence
+			pos += 3
+			continue
+		if not data[pos] in _allowed_types:   # ASCII
+			return True, None
+		if pos + 2 > len(data) or pos + 2 + data[pos+1] > len(data):
+			return False, None
+		if data[pos] == 1 and data[pos+1] == 1:   # Direct Dial
+			return True, decode_ext_from_direct_dial(data[pos+2])
+		if data[pos] not in (0, 7):   # Heartbeat and Version may come first
+			return True, None
+		pos += 2 + data[pos+1]
+	return False, None
+
+def peek_direct_dial(s:socket.socket, timeout:float, received:bytes=b'') -> str:
+	"""
+	Wait up to timeout for the dialled extension without consuming any data
+	(the protocol loop reads the packets again). received: what has come
+	before the data of the socket (read by the master while waiting).
+	Returns None if there is no extension.
+	"""
+	decided, ext = parse_direct_dial(received)
+	if decided:
+		return ext
+	t_end = time.monotonic() + timeout
+	data = b''
+	try:
+		while len(received) + len(data) < 64:
+			s.settimeout(max(0.001, t_end - time.monotonic()))
+			# one more byte than we have, MSG_WAITALL waits for it
+			new = s.recv(len(data) + 1, socket.MSG_PEEK | socket.MSG_WAITALL)
+			if len(new) <= len(data):
+				break   # remote has closed
+			data = new
+			decided, ext = parse_direct_dial(received + data)
+			if decided:
+				return ext
+	except (socket.timeout, OSError):
+		pass
+	finally:
+		s.settimeout(None)
+	return None
+
+def send_buffers(s, buffers:list):
+	"""
+	Send a list of buffers in one system call (sendmsg) if the socket can,
+	what it didn't take with sendall.
+	"""
+	sendmsg = getattr(s, 'sendmsg', None)
+	if sendmsg is None:
+		s.sendall(b''.join(buffers))
+		return
+	n = sendmsg(buffers)
+	if n < sum(len(b) for b in buffers):
+		s.sendall(b''.join(buffers)[n:])
+
 def display_hex(data:bytes) -> str:
 	"""
 	Convert a byte string into a string of hex values for diplay.
 	"""
 	return " ".join(hex(i) for i in data)
 
+def encode_baudot_packets(text:str) -> (bytes, int):
+	"""
+	Encode text into i-Telex Baudot data packets (2) like the protocol loop
+	does, for sending without a provider (e.g. the banner of the admission
+	queue). Returns the packets and the count of Baudot characters.
+	"""
+	bmc = txCode.BaudotMurrayCode(False, False, True)
+	code = bmc.encodeA2BM(txCode.BaudotMurrayCode.translate(text))
+	data = bytearray()
+	for i in range(0, len(code), 40):
+		chunk = code[i:i+40]
+		data.extend([2, len(chunk)])
+		data.extend(chunk)
+	return bytes(data), len(code)
+
 
 # Types of reject packets (see txDevMCP):
 #
@@ -108,21 +201,60 @@ def send_reject(self, s, msg = "abs"):
 class TelexConnClosed(Exception):
 	pass
 
+class TelexHibernate(Exception):
+	'''The provider has been parked at a hibernation point (see hibernate())'''
+	def __init__(self, step:str):
+		super().__init__(step)
+		self.step = step
+
 class TelexServiceProvider_base():
 	WRU = '12345 txss d'
 	ignoreWRU = False
 	_BuZi = '<'
+	_block_ascii = False
+	_sent_offset = 0   # Baudot characters already sent by the master (banner of the admission queue)
+	_received = b''    # received by the master while the caller was waiting (admission queue)
+	_extension = None  # extension this provider has been chosen for (txservice routing)
+	_remote = None     # address of the remote (host, port)
+	_wru = None        # txsWRU.Answerback while requestWRU() waits for it
+	# answerbacks of the callers (txsWRU.Cache, set by txservice), None: always ask
+	wruCache = None
+	is_async = False   # doHandleClient is a coroutine (see txServiceProvider_async)
+	_park = None       # set by a driver which can park sessions (asyncio core): returns True if there is room
+	_hibernated = None # step of the last hibernation
+	# size, high and low watermark of the character buffers: above the high
+	# watermark send() blocks (tx) or receiving is paused (rx) until the
+	# buffer has fallen to the low watermark
+	txBufferLimits = (4096, 2048, 512)
+	rxBufferLimits = (4096, 1024, 256)
+	# time of the protocol and the provider (see txsClock), e.g. a ScaledClock
+	# to run sessions faster than real time
+	clock = txsClock.REAL
+	# seconds (clock) without anything received, then the connection is ended (None: never)
+	idleTimeout = None
 
 	def __init__(self):
-		self._rx_buffer = []
-		self._tx_buffer = []
+		self._rx_buffer = Channel(*self.rxBufferLimits)
+		self._tx_buffer = Channel(*self.txBufferLimits)
 		self._acknowledge_counter = 0
 		self._send_acknowledge_idle = False
+		self._send_lock = Lock()   # taking from _tx_buffer and sending it is one step (End comes after)
+		# output queue: the packets of one iteration of the protocol loop go
+		# out with one flush(), an Acknowledge replaces a queued older one
+		self._out = []
+		self._out_ack = None   # index of the queued Acknowledge
+		self._out_lock = Lock()
+		self._out_packets = self._out_writes = 0
 
 ###########################################################################################
 
-	def send(self, s: str):
-		self._tx_buffer.extend(s)
+	def send(self, s: str, block: bool = True) -> int:
+		'''
+		Queue s for sending, returns the count of characters taken. Blocks
+		while the output buffer is above its high watermark, unless block is
+		False: then only as much as fits is taken.
+		'''
+		return self._tx_buffer.put(s, block)
 
 	def clearInputBuffer(self):
 		self._rx_buffer.clear()
@@ -132,72 +264,63 @@ class TelexServiceProvider_base():
 		return len(self._rx_buffer)
 	def getOutputLen(self):
 		return len(self._tx_buffer)
+	def isOutputThrottled(self):
+		return self._tx_buffer.throttled
 	def getLastBuZiMode(self):
 		return self._BuZi
 
-	def requestWRU(self):
-#		self.send('@')
-#		owru = self.recvUntil(['\n'])[0]+self.recvUntil(['\n'])[0]
-#		return owru.strip()
-		
-		
-		# wait until outputbuffer is send
-		# is_running() is needed, because connection could be closed and _tx_buffer has still contents
-		while self.is_running() and self.getOutputLen() > 0:
-			time.sleep(0.15)
-		
+	def requestWRU(self, cached:bool = True) -> str:
+		'''
+		Answerback of the remote: sends WRU (@) and returns as soon as the
+		answerback has arrived. A caller known from wruCache isn't asked
+		again, unless cached is False.
+		'''
+		owru = self._cachedWRU() if cached else None
+		if owru is not None:
+			return owru
+
+		# the protocol side takes the answerback out of the received characters
+		# once it has sent the @ (see _sending)
+		self._wru = txsWRU.Answerback(WRU_THRES)
+		if self._rx_buffer.closed:
+			self._wru.close()
 		self.send('@')
-		
-		lasttime = time.monotonic()
-		lastLen  = 0
-		gotInput = True
-		# then receive WRU
-		# is_running() is needed, because connection could be closed and _rx_buffer does not receive anymore… wait… then we shall fall out of while…
-		while self.is_running() and gotInput:
-			
-			time.sleep(0.15)
-			if self.getOutputLen() > 0:
-				continue
-			
-			newLen = self.getInputLen()
-			if newLen > lastLen:
-				lastLen = newLen
-				lasttime = time.monotonic()
-			elif newLen == lastLen and lastLen > 0:
-				now = time.monotonic()
-				if (now - lasttime > WRU_THRES):
-					gotInput = False
-			
-		owru = ''
-		while self.getInputLen() > 0:
-			c = self.recvChar()
-			if c in ['<','>','@','\r','\n']:
-				continue
-			owru += c
-			
-#			# in case rx buffer is already empty, wait additional two char length
-#			if (self.getInputLen() == 0):
-#				time.sleep(0.3)
-		return owru.strip()
+		self._wru.wait(self.clock)
+		return self._receivedWRU()
+
+	def _wruKey(self) -> str:
+		if not self._remote:
+			return None
+		return f"{self._remote[0]}/{self._extension or ''}"
+
+	def _cachedWRU(self) -> str:
+		key = self._wruKey()
+		if self.wruCache is None or key is None:
+			return None
+		owru = self.wruCache.get(key, self.clock.time())
+		if owru is not None:
+			l.debug(f"Answerback of {key} from the cache: {owru!r}")
+		return owru
+
+	def _receivedWRU(self) -> str:
+		wru, self._wru = self._wru, None
+		if wru.shift:
+			self._BuZi = wru.shift
+		owru = wru.result
+		key = self._wruKey()
+		if owru and self.wruCache is not None and key is not None:
+			self.wruCache.put(key, owru, self.clock.time())
+		return owru
 
 
 	def recvChar(self, returnWRU = False) -> str:
-		c = ''
-		# wait until new char arrives and connection is running
-		while len(self._rx_buffer) == 0 and self.is_running():
-			time.sleep(0.15) # 1 char is 1x start bit, 5x data, 1.5 stop = 0.15s
-		# if we got chars, try to get one
-		if len(self._rx_buffer) > 0:
-			try:
-				c = self._rx_buffer.pop(0)
-			except Exception:
-				# catch any possible exception (can be there one?)
-				pass
-		# if _rx_buffer still empty, the connection must be closed. Either by peer or by us.
+		# wait until new char arrives (or the connection is closed)
+		c = self._rx_buffer.get()
+		# if _rx_buffer is empty, the connection must be closed. Either by peer or by us.
 		# in both cases, we want to get to an end. So we raise an exception which only is catched
 		# at the point where the subroutine for this server is called.
 		# So no "is_running" is needed at every reading while loop anymore.
-		else:
+		if c is None:
 			raise TelexConnClosed()
 		if c in ['<','>']:
 			self._BuZi = c
@@ -232,6 +355,11 @@ class TelexServiceProvider_base():
 		
 	def recvCorrLine(self, cancelStr = 'xxx', onlyAtEnd = True) -> str:
 		s,e = self.recvUntil(['\n'])
+		return self._corrLine(s, cancelStr, onlyAtEnd)
+
+	@staticmethod
+	def _corrLine(s, cancelStr, onlyAtEnd) -> str:
+		'''The line s without what is cancelled by cancelStr'''
 		s = s.strip()
 		lenCS = len(cancelStr)
 		if (s[-lenCS:] == cancelStr):
@@ -293,6 +421,27 @@ class TelexServiceProvider_base():
 					ret = vo
 		return ret
 
+# Hibernation: while the caller is thinking or typing at a prompt, the
+# asyncio core can park a synchronous provider. Its thread ends and the
+# session gives its slot of maxConcurrent back; the provider object stays as
+# it is (attributes, buffers, protocol state), so nothing has to be saved.
+# When a complete line has arrived, doResume(step) continues in a thread.
+#
+#	self.send('a = abfahrt. v = verbindung.\r\n')
+#	self.hibernate('main')        # doResume('main') has to go on from here
+#	mode = self.getInputOption(['a','v'])
+#
+# In process mode, and for providers without doResume(), hibernate() just returns.
+	def hibernate(self, step:str):
+		'''Hibernation point: park the session here if the driver can and no line is waiting'''
+		if self._park is None or type(self).doResume is TelexServiceProvider_base.doResume:
+			return
+		if '\n' not in self._rx_buffer.peek(len(self._rx_buffer)) and self._park():
+			raise TelexHibernate(step)
+
+	def doResume(self, step:str):
+		'''Continue at the hibernation point step (a line has arrived), derived classes which hibernate have it'''
+
 ###########################################################################################
 
 
@@ -303,12 +452,29 @@ class TelexServiceProvider_base():
 	def handle_client(self, s:socket.socket, addr, sema, stop):
 		# start the i-telex-connection thread
 		self._stop = stop
+		self._remote = addr
 		self._t = Thread(target=self.handle_client_conn, name='txsConn', args=(s,addr,sema))
 		self._t.start()
-		
+
+		self.run_provider()
+		with self._send_lock:
+			self.send_end(s)
+
+	# runs the actual program of the service
+	# (also called by the adapter of the asyncio core, see txsAsync)
+	# (step: resume a parked session there)
+	def run_provider(self, step:str=None):
+		self._hibernated = None
 		try:
 			# now do what to do
-			self.doHandleClient()
+			if step is None:
+				self.doHandleClient()
+			else:
+				self.doResume(step)
+		except TelexHibernate as e:
+			# parked: the protocol goes on sending what is in _tx_buffer
+			self._hibernated = e.step
+			l.debug(f"Hibernating at {e.step!r}")
 		except TelexConnClosed:
 			l.info('Conn closed while reading.')
 		except:
@@ -317,10 +483,9 @@ class TelexServiceProvider_base():
 			pass
 		finally:
 			# wait to flush the _tx_buffer (if connection still there)
-			while self.is_running() and self._tx_buffer:
-				time.sleep(len(self._tx_buffer)*0.15)
-			self.send_end(s)
-	
+			if self._hibernated is None:
+				self._tx_buffer.wait_empty()
+
 	# just for deriving purpose
 	def doHandleClient(self):
 		self.send('\r\nservice provider base class. not meant to be called.\r\n')
@@ -330,324 +495,457 @@ class TelexServiceProvider_base():
 		"""Handles a client or server connection."""
 
 		# print("process_connection")
-		
-		
-		time_2Hz = time.monotonic()
-		time_20Hz = time.monotonic()
-		time_200Hz = time.monotonic()
-		
+
+		# the loop sleeps until the socket is readable, the provider has
+		# queued characters or read enough of the received ones (wake-up
+		# socket), or the next deadline (Acknowledge, sending, idle timeout)
+		sel = selectors.DefaultSelector()
+		wake_r, self._wake_w = socket.socketpair()
+		wake_r.setblocking(False)
+		self._wake_w.setblocking(False)
 		try:
 			#s.sendall(b"Welcome! Send data and it will be echoed back.\n")
-			
-			is_ascii = None
-			
-			bmc = txCode.BaudotMurrayCode(False, False, True)
-			sent_counter = 0
-			self._received_counter = 0
-			timeout_counter = -1
-			time_next_send = None
-			error = False
-
-			s.settimeout(0.2)
 
-			# Store remote protocol version to control negotiation
-			self._remote_protocol_ver = None
-
-			self._acknowledge_counter = self._last_acknowledge_counter = 0 #-24 # fixed length of welcome banner, see txDevMCP
-
-			self.send_ack(s, 0) # -24 # fixed length of welcome banner, see txDevMCP
+			s.settimeout(self.clock.timeout(TICK))   # for sendall
+			# we batch the packets ourselves (flush), Nagle would only delay them
+			try:
+				s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			except OSError:
+				pass
+			sel.register(wake_r, selectors.EVENT_READ)
+			reading = False
+			self._tx_buffer.on_data = self._rx_buffer.on_low = self._wake
 
-			while not self._stop.is_set():
-			
-				# time-things
-				time_act = int(time.monotonic() * 1000)   #time in ms
-				if (time_act - time_2Hz) >= 500:
-					time_2Hz = time_act
-					
-					# process idle2Hz
+			self.handle_conn_start(s)
 
-					# Send Acknowledge if fully connected (only set flag because we're out
-					# of context)
-					self._send_acknowledge_idle = True
+			# whatever one recv brings, the parser cuts it into packets and ASCII characters
+			parser = txsFrame.FrameParser()
+			ended = False
+			# what the master has received while the caller was waiting comes first
+			pending = bool(self._received)
+			parser.feed(self._received)
+			self._received = b''
 
+			while not self._stop.is_set() and not ended:
 
+				self.handle_conn_idle()
 
-			
-			
 				try:
-					data = s.recv(1)
-
 					# piTelex terminates; close connection
 					#if not self._run:
 					#	break
 
-					# lost connection
-					if not data:
-						l.warning("Remote has closed connection")
-						break
+					# the provider doesn't keep up with reading: stop receiving,
+					# TCP throttles the remote (then go on with the frames
+					# left in the parser)
+					if reading == self._rx_buffer.throttled:
+						reading = not reading
+						if reading:
+							sel.register(s, selectors.EVENT_READ)
+						else:
+							sel.unregister(s)
+
+					# what the last iteration has queued goes out at once
+					self.flush(s)
+
+					deadline = self.next_deadline()
+					wait = STOP_POLL
+					if deadline is not None:
+						wait = min(wait, self.clock.timeout(max(0.0, deadline - self.clock.monotonic())))
+					if pending:
+						wait = 0   # parse it at once
+						pending = False
+
+					for key, mask in sel.select(wait):
+						if key.fileobj is wake_r:
+							try:
+								while wake_r.recv(64):
+									pass
+							except BlockingIOError:
+								pass
+							self.handle_tx_data()
 
-					# Telnet control sequence
-					elif data[0] == 255:
-						d = s.recv(2)   # skip next 2 bytes from telnet command
-
-					# i-Telex packet
-					elif data[0] in allowed_types():
-						packet_error = False
-
-						d = s.recv(1)
-						data += d
-						packet_len = d[0]
-						if packet_len:
-							data += s.recv(packet_len)
-
-						# Heartbeat
-						if data[0] == 0 and packet_len == 0:
-							l.debug('Received i-Telex packet: Heartbeat ({})'.format(display_hex(data)))
-
-						# Direct Dial
-						elif data[0] == 1 and packet_len == 1:
-							l.debug('Received i-Telex packet: Direct dial ({})'.format(display_hex(data)))
-
-							# Disable emitting "direct dial" command, since it's
-							# currently not acted upon anywhere.
-							#with self._rx_lock:
-							#	self._rx_buffer.append('\x1bD'+str(data[2]))
-
-							# Instead, only accept extension 0 (i-Telex default)
-							# and None, and reject all others.
-							ext = decode_ext_from_direct_dial(data[2])
-							l.info('Direct Dial, extension {}'.format(ext))
-							if not ext in ('0', None):
-								self.send_reject(s, 'na')
-								error = True
-								break
-
-						# Baudot Data
-						elif data[0] == 2 and packet_len >= 1 and packet_len <= 50:
-							l.debug('Received i-Telex packet: Baudot data ({})'.format(display_hex(data)))
-							aa = bmc.decodeBM2A(data[2:])
-#							with self._rx_lock:
-							for a in aa:
-#								if a == '@':
-#									a = '#'
-								self._rx_buffer.append(a)
-								
-							self._received_counter += len(data[2:])
-							# Send Acknowledge if printer is running and we've got
-							# at least 16 characters left to print
-#							if self._print_buf_len >= 16:
-#								self.send_ack(s, self._acknowledge_counter)
-							self.send_ack(s, self._received_counter)
-
-						# End
-						elif data[0] == 3 and packet_len == 0:
-							l.debug('Received i-Telex packet: End ({})'.format(display_hex(data)))
-							l.info('End by remote')
-							break
+						# lost connection
+						elif not parser.recv_into(s):
+							l.warning("Remote has closed connection")
+							ended = True
 
-						# Reject
-						elif data[0] == 4 and packet_len <= 20:
-							l.debug('Received i-Telex packet: Reject ({})'.format(display_hex(data)))
-							aa = data[2:].decode('ASCII', errors='ignore')
-							# i-Telex may pad with \x00 (e.g. "nc\x00"); remove padding
-							aa = aa.rstrip('\x00')
-							l.info('i-Telex connection rejected, reason {!r}'.format(aa))
-							break
+					if ended:
+						break
 
-						# Acknowledge
-						elif data[0] == 6 and packet_len == 1:
-							l.debug('Received i-Telex packet: Acknowledge ({})'.format(display_hex(data)))
-							# TODO: Fix calculation and prevent overflows, e.g. if
-							# the first ACK is sent with a low positive value. This
-							# might be done by saving the first ACK's absolute
-							# counter value and only doing difference calculations
-							# afterwards.
-							unprinted = (sent_counter - int(data[2])) & 0xFF
-							#if unprinted < 0:
-							#	unprinted += 256
-							l.debug(str(data[2])+'/'+str(sent_counter)+'='+str(unprinted) + " (printed/sent=unprinted)")
-							if unprinted < 7:   # about 1 sec
-								time_next_send = None
-							else:
-								time_next_send = time.monotonic() + (unprinted-6)*0.15
-							# Send Acknowledge if printer is running and remote end
-							# has printed all sent characters
-							# ! Better not, this will create an Ack flood !
-							# if self._connected >= ST.CON_FULL and unprinted == 0:
-							#	 self.send_ack(s, self._acknowledge_counter)
-
-
-						# Version
-						elif data[0] == 7 and packet_len >= 1 and packet_len <= 20:
-							aa = ''
-							if packet_len > 1:
-								aa = data[3:].decode('ASCII', errors='ignore')
-								aa = aa.rstrip('\x00')
-							l.info(f"Received i-Telex packet: Version {data[2]} '{aa}' ({display_hex(data)})")
-							if self._remote_protocol_ver is None:
-								if data[2] != 1:
-									# This is the first time an unsupported version was offered
-									l.warning("Unsupported version offered by remote ({}), requesting v1".format(display_hex(data[2:])))
-									self.send_version(s)
-								else:
-									# Only send version packet in response to valid
-									# version when we're server, because as client,
-									# we sent a version packet directly after
-									# connecting.
-									self.send_version(s)
-								# Store offered version
-								self._remote_protocol_ver = data[2]
-							else:
-								if data[2] != 1:
-									# The remote station insists on incompatible
-									# version. Send the not-officially-defined
-									# error code "ver".
-									l.error("Unsupported version insisted on by remote ({})".format(display_hex(data[2:])))
-									self.send_reject(s, 'ver')
-									error = True
-									break
-								else:
-									if data[2] != self._remote_protocol_ver:
-										l.info("Negotiated protocol version {}, initial request was {}".format(data[2], self._remote_protocol_ver))
-										self._remote_protocol_ver = data[2]
-									else:
-										# Ignore multiple good version packets
-										l.info("Redundant Version packet")
-
-						# Self test
-						elif data[0] == 8 and packet_len >= 2:
-							l.debug('Received i-Telex packet: Self test ({})'.format(display_hex(data)))
-
-						# Remote config
-						elif data[0] == 9 and packet_len >= 3:
-							l.info('Received i-Telex packet: Remote config ({})'.format(display_hex(data)))
-
-						# Wrong packet - will resync at next socket.timeout
+					for kind, frame in parser:
+						# ASCII character(s)
+						if kind == txsFrame.ASCII:
+							ended = self.handle_ascii(s, bytes(frame))
+						# i-Telex packet
 						else:
-							l.warning('Received invalid i-Telex Packet: {}'.format(display_hex(data)))
-							packet_error = True
-
-						if not packet_error:
-							if is_ascii is None:
-								l.info('Detected i-Telex connection')
-								is_ascii = False
-							elif is_ascii:
-								l.warning('Detected i-Telex connection, but ASCII was expected')
-								is_ascii = False
-
-						# Also send Acknowledge packet if triggered by idle function
-						if self._send_acknowledge_idle:
-							self._send_acknowledge_idle = False
-#							self.send_ack(s, self._acknowledge_counter)
-							self.send_ack(s, self._received_counter)
-
-					# ASCII character(s)
-					else:
-						l.debug('Received non-i-Telex data: {} ({})'.format(repr(data), display_hex(data)))
-
-						if self._block_ascii:
-							l.warning("Incoming ASCII connection blocked")
+							ended = self.handle_packet(s, frame)
+						if ended or self._rx_buffer.throttled:
 							break
 
-						if is_ascii is None:
-							l.info('Detected ASCII connection')
-							is_ascii = True
-						elif not is_ascii:
-							l.warning('Detected ASCII connection, but i-Telex was expected')
-							is_ascii = True
-						
-						data = data.decode('ASCII', errors='ignore').upper()
-						data = txCode.BaudotMurrayCode.translate(data)
-						#with self._rx_lock:
-						for a in data:
-#							if a == '@':
-#								a = '#'
-							self._rx_buffer.append(a)
-							self._received_counter += 1
+					if not ended:
+						ended = self.handle_timeout(s)
 
 				except socket.timeout:
-					#l.debug('.')
-					if is_ascii is not None:   # either ASCII or baudot connection detected
-						timeout_counter += 1
-
-						if is_ascii:
-							if self._tx_buffer:
-								sent = self.send_data_ascii(s)
-								sent_counter += sent
-
-						else:   # baudot
-							if (timeout_counter % 5) == 0:   # every 1 sec
-								# Send Acknowledge if printer is running
-#								self.send_ack(s, self._acknowledge_counter)
-								self.send_ack(s, self._received_counter)
-
-							if self._tx_buffer:
-								if time_next_send and time.monotonic() < time_next_send:
-									l.debug('Sending paused for {:.3f} s'.format(time_next_send-time.monotonic()))
-									pass
-								else:
-									sent = self.send_data_baudot(s, bmc)
-									sent_counter += sent
-									if sent > 7:
-										time_next_send = time.monotonic() + (sent-6)*0.15
-
-							elif (timeout_counter % 15) == 0:   # every 3 sec
-								#self.send_heartbeat(s)
-								pass
-								# Suppress Heartbeat for now
-								#
-								# Background: The spec and personal conversation
-								# with Fred yielded that i-Telex uses Heartbeat
-								# only until the printer has been started. After
-								# that, only Acknowledge is used.
-								#
-								# Complications arise from the fact that some
-								# services in the i-Telex network interpret
-								# Heartbeat just like Acknowledge, i.e. printer is
-								# started and printer buffer empty. Special case is
-								# the 11150 service, which in the current version,
-								# on receiving Heartbeat, sends a WRU whilst the
-								# welcome banner is being printed, causing a
-								# character jumble.
-
+					# sendall didn't get rid of the data in time
+					l.debug("Timeout while sending")
 
 				except (socket.error,BrokenPipeError,ConnectionResetError):
 					l.error("Exception caught:", exc_info = sys.exc_info())
-					error = True
+					self._conn_error = True
 					break
 
 		except (KeyboardInterrupt, SystemExit):
 			l.info('Exit by Keyboard')
-		
+
 		# catch again because at time as the initial ack the connection can already be closed again
 		except (socket.error,BrokenPipeError,ConnectionResetError):
 			l.error("Exception caught:", exc_info = sys.exc_info())
-			error = True
+			self._conn_error = True
 
 		finally:
-			if not is_ascii:
-				# Don't send end packet in case of error. There may be two error
-				# cases:
-				# - Protocol error: We've already sent a reject package.
-				# - Network error: There's no connection to send over anymore.
-				if not error:
-					self.send_end(s)
-			l.info('end connection')
+			self._tx_buffer.on_data = self._rx_buffer.on_low = None
+			sel.close()
+			wake_r.close()
+			self._wake_w.close()
+			self.handle_conn_end(s)
 
 			# Freigeben der Semaphore beim Beenden des Prozesses
-			try:
-				sema.release()
-			except Exception:
-				pass
+			# (None: the slot is managed by the master, see txservice.SlotLedger)
+			if sema is not None:
+				try:
+					sema.release()
+				except Exception:
+					pass
+
+
+	def _wake(self):
+		# from the provider thread: wake up the protocol loop
+		try:
+			self._wake_w.send(b'\0')
+		except OSError:   # full (it is awake anyway) or closed
+			pass
+
 
+	# The handle_conn_…/handle_… methods hold the i-telex protocol itself.
+	# They are driven either by handle_client_conn (one thread per connection)
+	# or by the asyncio core (txsAsync). s only has to provide sendall() (and
+	# sendmsg() for fewer system calls). The packets are queued, the driver
+	# calls flush() after handling what it has received or what was due.
+
+	def handle_conn_start(self, s):
+		'''Initialise the protocol state and send the first Acknowledge'''
+		self._is_ascii = None
+		self._bmc = txCode.BaudotMurrayCode(False, False, True, clock=self.clock)
+		self._sent_counter = self._sent_offset
+		self._received_counter = 0
+		now = self.clock.monotonic()
+		self._flow = txsFlow.AckWindow(self._sent_counter, now)
+		self._time_2Hz = now
+		self._t_received = now
+		self._timers = txsClock.Timers()
+		if self.idleTimeout:
+			self._timers.schedule('idle', now + self.idleTimeout)
+		self._conn_error = False
+
+		# Store remote protocol version to control negotiation
+		self._remote_protocol_ver = None
+
+		self._acknowledge_counter = self._last_acknowledge_counter = 0 #-24 # fixed length of welcome banner, see txDevMCP
+
+		self.send_ack(s, 0) # -24 # fixed length of welcome banner, see txDevMCP
+
+	def handle_conn_idle(self):
+		'''Time-things, called once per iteration of the protocol loop'''
+		time_act = self.clock.monotonic()
+		if (time_act - self._time_2Hz) >= 0.5:
+			self._time_2Hz = time_act
+
+			# process idle2Hz
+
+			# Send Acknowledge if fully connected (only set flag because we're out
+			# of context)
+			self._send_acknowledge_idle = True
+
+	def handle_packet(self, s, data) -> bool:
+		'''Process one complete i-Telex packet (bytes or a memoryview of txsFrame), returns True if the connection has to be ended'''
+		packet_error = False
+		packet_len = data[1]
+		self._t_received = self.clock.monotonic()
+
+		# Heartbeat
+		if data[0] == 0 and packet_len == 0:
+			l.debug('Received i-Telex packet: Heartbeat ({})'.format(display_hex(data)))
+
+		# Direct Dial
+		elif data[0] == 1 and packet_len == 1:
+			l.debug('Received i-Telex packet: Direct dial ({})'.format(display_hex(data)))
+
+			# Disable emitting "direct dial" command, since it's
+			# currently not acted upon anywhere.
+			#with self._rx_lock:
+			#	self._rx_buffer.append('\x1bD'+str(data[2]))
+
+			# Instead, only accept extension 0 (i-Telex default),
+			# None and the one we were routed for, and reject all others.
+			ext = decode_ext_from_direct_dial(data[2])
+			l.info('Direct Dial, extension {}'.format(ext))
+			if not ext in ('0', None, self._extension):
+				self.flush(s)
+				self.send_reject(s, 'na')
+				self._conn_error = True
+				return True
+
+		# Baudot Data
+		elif data[0] == 2 and packet_len >= 1 and packet_len <= 50:
+			l.debug('Received i-Telex packet: Baudot data ({})'.format(display_hex(data)))
+			aa = self._bmc.decodeBM2A(data[2:])
+			self.put_received(aa)
+
+			self._received_counter += len(data[2:])
+			# Send Acknowledge if printer is running and we've got
+			# at least 16 characters left to print
+#			if self._print_buf_len >= 16:
+#				self.send_ack(s, self._acknowledge_counter)
+			self.send_ack(s, self._received_counter)
+
+		# End
+		elif data[0] == 3 and packet_len == 0:
+			l.debug('Received i-Telex packet: End ({})'.format(display_hex(data)))
+			l.info('End by remote')
+			return True
+
+		# Reject
+		elif data[0] == 4 and packet_len <= 20:
+			l.debug('Received i-Telex packet: Reject ({})'.format(display_hex(data)))
+			aa = bytes(data[2:]).decode('ASCII', errors='ignore')
+			# i-Telex may pad with \x00 (e.g. "nc\x00"); remove padding
+			aa = aa.rstrip('\x00')
+			l.info('i-Telex connection rejected, reason {!r}'.format(aa))
+			return True
+
+		# Acknowledge
+		elif data[0] == 6 and packet_len == 1:
+			l.debug('Received i-Telex packet: Acknowledge ({})'.format(display_hex(data)))
+			# absolute counters and print rate, see txsFlow
+			self._flow.on_ack(data[2], self.clock.monotonic())
+			# the window has opened: go on sending at once
+			if self._tx_buffer and not self._is_ascii:
+				self.send_data_window(s)
+			# Send Acknowledge if printer is running and remote end
+			# has printed all sent characters
+			# ! Better not, this will create an Ack flood !
+			# if self._connected >= ST.CON_FULL and unprinted == 0:
+			#	 self.send_ack(s, self._acknowledge_counter)
+
+
+		# Version
+		elif data[0] == 7 and packet_len >= 1 and packet_len <= 20:
+			aa = ''
+			if packet_len > 1:
+				aa = bytes(data[3:]).decode('ASCII', errors='ignore')
+				aa = aa.rstrip('\x00')
+			l.info(f"Received i-Telex packet: Version {data[2]} '{aa}' ({display_hex(data)})")
+			if self._remote_protocol_ver is None:
+				if data[2] != 1:
+					# This is the first time an unsupported version was offered
+					l.warning("Unsupported version offered by remote ({}), requesting v1".format(display_hex(data[2:])))
+					self.send_version(s)
+				else:
+					# Only send version packet in response to valid
+					# version when we're server, because as client,
+					# we sent a version packet directly after
+					# connecting.
+					self.send_version(s)
+				# Store offered version
+				self._remote_protocol_ver = data[2]
+			else:
+				if data[2] != 1:
+					# The remote station insists on incompatible
+					# version. Send the not-officially-defined
+					# error code "ver".
+					l.error("Unsupported version insisted on by remote ({})".format(display_hex(data[2:])))
+					self.flush(s)
+					self.send_reject(s, 'ver')
+					self._conn_error = True
+					return True
+				else:
+					if data[2] != self._remote_protocol_ver:
+						l.info("Negotiated protocol version {}, initial request was {}".format(data[2], self._remote_protocol_ver))
+						self._remote_protocol_ver = data[2]
+					else:
+						# Ignore multiple good version packets
+						l.info("Redundant Version packet")
 
+		# Self test
+		elif data[0] == 8 and packet_len >= 2:
+			l.debug('Received i-Telex packet: Self test ({})'.format(display_hex(data)))
+
+		# Remote config
+		elif data[0] == 9 and packet_len >= 3:
+			l.info('Received i-Telex packet: Remote config ({})'.format(display_hex(data)))
+
+		# Wrong packet (impossible lengths are already dropped by the frame parser)
+		else:
+			l.warning('Received invalid i-Telex Packet: {}'.format(display_hex(data)))
+			packet_error = True
+
+		if not packet_error:
+			if self._is_ascii is None:
+				l.info('Detected i-Telex connection')
+				self._detected(False)
+			elif self._is_ascii:
+				l.warning('Detected i-Telex connection, but ASCII was expected')
+				self._detected(False)
+
+		# Also send Acknowledge packet if triggered by idle function
+		if self._send_acknowledge_idle:
+			self._send_acknowledge_idle = False
+#			self.send_ack(s, self._acknowledge_counter)
+			self.send_ack(s, self._received_counter)
+
+		return False
+
+	def handle_ascii(self, s, data) -> bool:
+		'''Process received non-i-Telex data, returns True if the connection has to be ended'''
+		l.debug('Received non-i-Telex data: {} ({})'.format(repr(data), display_hex(data)))
+
+		if self._block_ascii:
+			l.warning("Incoming ASCII connection blocked")
+			return True
+		self._t_received = self.clock.monotonic()
+
+		if self._is_ascii is None:
+			l.info('Detected ASCII connection')
+			self._detected(True)
+		elif not self._is_ascii:
+			l.warning('Detected ASCII connection, but i-Telex was expected')
+			self._detected(True)
+
+		data = data.decode('ASCII', errors='ignore').upper()
+		data = txCode.BaudotMurrayCode.translate(data)
+		self.put_received(data)
+		self._received_counter += len(data)
+		return False
+
+	def put_received(self, chars:str):
+		'''Hand received characters to the provider (never blocks the protocol side)'''
+		wru = self._wru
+		if wru is not None and wru.armed:
+			chars = wru.feed(chars, self.clock.monotonic())
+		n = self._rx_buffer.put(chars, False)
+		if n < len(chars):
+			l.warning('Receive buffer full, {} characters dropped'.format(len(chars) - n))
+
+	def _detected(self, is_ascii:bool):
+		'''Type of the connection known: start the timers'''
+		self._is_ascii = is_ascii
+		now = self.clock.monotonic()
+		if is_ascii:
+			self._timers.cancel('ack')
+		else:
+			self._timers.schedule_before('ack', now + ACK_INTERVAL)
+		if self._tx_buffer:
+			self._timers.schedule_before('send', now)
+
+	def handle_tx_data(self):
+		'''The provider has queued characters (the output buffer was empty): send them as soon as possible'''
+		if self._is_ascii is not None:
+			self._timers.schedule_before('send', self.clock.monotonic())
+
+	def next_deadline(self) -> float:
+		'''Clock time when handle_timeout has something to do, None: nothing scheduled'''
+		return self._timers.next()
+
+	def handle_timeout(self, s) -> bool:
+		'''Run the timers which are due (Acknowledge, sending, idle timeout), returns True if the connection has to be ended'''
+		now = self.clock.monotonic()
+		for name in self._timers.pop_due(now):
+			if name == 'ack':
+				# Send Acknowledge if printer is running
+#				self.send_ack(s, self._acknowledge_counter)
+				self.send_ack(s, self._received_counter)
+				self._timers.schedule('ack', now + ACK_INTERVAL)
+				# no Heartbeat, only Acknowledge
+				#
+				# Background: The spec and personal conversation
+				# with Fred yielded that i-Telex uses Heartbeat
+				# only until the printer has been started. After
+				# that, only Acknowledge is used.
+				#
+				# Complications arise from the fact that some
+				# services in the i-Telex network interpret
+				# Heartbeat just like Acknowledge, i.e. printer is
+				# started and printer buffer empty. Special case is
+				# the 11150 service, which in the current version,
+				# on receiving Heartbeat, sends a WRU whilst the
+				# welcome banner is being printed, causing a
+				# character jumble.
+
+			elif name == 'send':
+				if self._is_ascii:
+					with self._send_lock:
+						sent = self.send_data_ascii(s)
+					self._sent_counter += sent
+					if self._tx_buffer:
+						self._timers.schedule('send', now + TICK)
+				elif self._is_ascii is not None:
+					self.send_data_window(s)
+
+			elif name == 'idle':
+				if now - self._t_received >= self.idleTimeout:
+					l.info('Nothing received for {} s, ending connection'.format(self.idleTimeout))
+					return True
+				self._timers.schedule('idle', self._t_received + self.idleTimeout)
+		return False
+
+	def handle_conn_end(self, s):
+		'''The connection is over, send End packet if appropriate'''
+		self.conn_closed()
+		if not self._is_ascii:
+			if self._flow.printed:
+				l.info('Remote printed {} characters, about {:.1f} per second'.format(self._flow.printed, self._flow.rate))
+			# Don't send end packet in case of error. There may be two error
+			# cases:
+			# - Protocol error: We've already sent a reject package.
+			# - Network error: There's no connection to send over anymore.
+			if not self._conn_error:
+				self.send_end(s)
+		l.debug('Sent {} packets in {} writes'.format(self._out_packets, self._out_writes))
+		l.info('end connection')
+
+	def conn_closed(self):
+		'''No more characters will be received or sent: wake up the waiting provider'''
+		self._rx_buffer.close()
+		self._tx_buffer.close()
+		wru = self._wru
+		if wru is not None:
+			wru.close()
+
+
+
+	def queue(self, data):
+		'''Queue packet(s) for the next flush()'''
+		with self._out_lock:
+			self._out.append(data)
+
+	def flush(self, s):
+		'''Send the queued packets, in one system call if possible'''
+		with self._out_lock:
+			if not self._out:
+				return
+			out, self._out = self._out, []
+			self._out_ack = None
+			self._out_packets += len(out)
+			self._out_writes += 1
+			send_buffers(s, out)
 
 
 	def send_heartbeat(self, s):
 		'''Send heartbeat packet (0)'''
 		data = bytearray([0, 0])
 		l.debug('Sending i-Telex packet: Heartbeat ({})'.format(display_hex(data)))
-		s.sendall(data)
+		self.queue(data)
 
 
 	def send_ack(self, s, printed:int):
@@ -696,10 +994,13 @@ class TelexServiceProvider_base():
 
 		data = bytearray([6, 1, printed & 0xff])
 		l.debug('Sending i-Telex packet: Acknowledge ({})'.format(display_hex(data)))
-#		try:
-		s.sendall(data)
-#		except (BrokenPipeError,ConnectionResetError):
-#			pass
+		with self._out_lock:
+			if self._out_ack is None:
+				self._out_ack = len(self._out)
+				self._out.append(data)
+			else:
+				# only the newest count matters
+				self._out[self._out_ack] = data
 
 
 	def send_version(self, s):
@@ -711,7 +1012,7 @@ class TelexServiceProvider_base():
 			send.append(0)
 		send[1] = len(send) - 2 # length
 		l.debug('Sending i-Telex packet: Version ({})'.format(display_hex(send)))
-		s.sendall(send)
+		self.queue(send)
 
 
 	def send_direct_dial(self, s, dial:str):
@@ -721,36 +1022,62 @@ class TelexServiceProvider_base():
 		ext = encode_ext_for_direct_dial(dial)
 		data.append(ext)
 		l.debug('Sending i-Telex packet: Direct dial ({})'.format(display_hex(data)))
-		s.sendall(data)
+		self.queue(data)
 
 
 	def send_data_ascii(self, s):
 		'''Send ASCII data direct'''
-		a = ''
-		while self._tx_buffer and len(a) < 250:
-			b = self._tx_buffer.pop(0)
-			if b not in '<>°%':
-				a += b
+		a = ''.join(b for b in self._sending(self._tx_buffer.take(250)) if b not in '<>°%')
 		data = a.encode('ASCII')
 		l.debug('Sending non-i-Telex data: {} ({})'.format(repr(data), display_hex(data)))
-		s.sendall(data)
+		if data:
+			self.queue(data)
 		return len(data)
 
 
-	def send_data_baudot(self, s, bmc):
-		'''Send baudot data packet (2)'''
-		data = bytearray([2, 0])
-		while self._tx_buffer and len(data) < 42:
-			a = self._tx_buffer.pop(0)
-			bb = bmc.encodeA2BM(a)
-			if bb:
-				for b in bb:
-					data.append(b)
-		length = len(data) - 2
-		data[1] = length
-		l.debug('Sending i-Telex packet: Baudot data ({})'.format(display_hex(data)))
-		s.sendall(data)
-		return length
+	def _sending(self, chars:str) -> str:
+		'''Characters taken from _tx_buffer to be sent: with the @ of requestWRU the answerback begins'''
+		wru = self._wru
+		if wru is not None and not wru.armed and '@' in chars:
+			wru.armed = True
+		return chars
+
+
+	def send_data_window(self, s):
+		'''Send as much baudot data as the flow control (txsFlow) allows, returns the count'''
+		now = self.clock.monotonic()
+		budget = self._flow.budget(now)
+		sent = 0
+		if budget:
+			with self._send_lock:
+				sent = self.send_data_baudot(s, self._bmc, budget)
+			self._sent_counter += sent
+			self._flow.on_sent(sent, now)
+		else:
+			l.debug('Sending paused, {} characters unprinted'.format(self._flow.unprinted))
+		if self._tx_buffer:
+			# go on when the printer has made room (or with the next Acknowledge), in steps of TICK at most
+			resume = self._flow.next_send(now)
+			if resume is None:
+				self._timers.cancel('send')
+			else:
+				self._timers.schedule('send', max(resume, now + TICK))
+		return sent
+
+	def send_data_baudot(self, s, bmc, budget:int=50):
+		'''Send baudot data packets (2) with up to budget characters, returns the count'''
+		# encode what fits into budget in one call, the rest stays in _tx_buffer
+		code, n = bmc.encode_chunk(self._tx_buffer.peek(budget), budget)
+		self._sending(self._tx_buffer.take(n))
+		data = bytearray()
+		for i in range(0, len(code), 50):
+			chunk = code[i:i+50]
+			data.extend([2, len(chunk)])
+			data.extend(chunk)
+		if data:
+			l.debug('Sending i-Telex packet: Baudot data ({})'.format(display_hex(data)))
+			self.queue(data)
+		return len(code)
 
 
 	def send_end(self, s):
@@ -758,6 +1085,7 @@ class TelexServiceProvider_base():
 		send = bytearray([3, 0])   # End
 		l.debug('Sending i-Telex packet: End ({})'.format(display_hex(send)))
 		try:   # socket can possible be closed by other side
+			self.flush(s)
 			s.sendall(send)
 		except:
 			pass
@@ -769,6 +1097,7 @@ class TelexServiceProvider_base():
 		send.extend([ord(i) for i in reason])
 		l.debug(f'Sending i-Telex packet: End {reason} ({display_hex(send)})')
 		try:   # socket can possible be closed by other side
+			self.flush(s)
 			s.sendall(send)
 		except:
 			pass
@@ -801,14 +1130,14 @@ class TelexServiceProvider_base():
 		tns_pin = self._tns_pin.to_bytes(length=2, byteorder="little")
 		send.extend(tns_pin)
 		l.debug('Sending i-Telex packet: Connect Remote ({})'.format(display_hex(send)))
-		s.sendall(send)
+		self.queue(send)
 
 
 	def send_accept_call_remote(self, s):
 		'''Send accept call remote packet (0x84)'''
 		send = bytearray([132, 0])   # 84 Accept call remote
 		l.debug('Sending i-Telex packet: Accept call remote ({})'.format(display_hex(send)))
-		s.sendall(send)
+		self.queue(send)
 
 
 
@@ -21,9 +21,12 @@ class TelexServiceProvider_debug():
 	def getLastBuZiMode(self):
 		return '<'
 		
-	def requestWRU(self):
+	def requestWRU(self, cached = True):
 		return 'WRU was requested'
 
+	def hibernate(self, step):
+		return
+
 	def recvCorrLine(self):
 		return input()
 
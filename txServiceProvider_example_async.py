@@ -0,0 +1,29 @@
+#!/bin/env python3
+
+import logging
+l = logging.getLogger("txs." + __name__)
+
+# txServiceProvider_example for asyncio: the same program, every input and
+# output is awaited
+from txServiceProvider_async import TelexServiceProvider_async as TxSP_base
+
+
+class TelexServiceProvider(TxSP_base):
+
+	async def doHandleClient(self):
+		# this will print a text on the teletype
+		await self.send('\r\nWelcome. Send data and it will be echoed back.\r\n')
+
+		# while we are connected and not got SIGTERM
+		# ATTENTION! EVERY loop which expects an input MUST HAVE "self.is_running()" !
+		while self.is_running():
+
+			s = ''
+			# (else it would run unlimited in the loop!!!)
+			while len(s) == 0:
+				await self.send('Ask: ')
+				s = await self.recvCorrLine()
+
+#			s = await self.getInput('Ask')
+			await self.send('Got: '+s+'\n')
+		l.debug('Stopped or conn is closed.')
@@ -0,0 +1,614 @@
+#!/bin/env python3
+"""
+Telex Service Server - asyncio core
+One process multiplexes many i-telex connections on a single event loop.
+
+The i-telex protocol of a connection (handle_packet, handle_timeout, … of
+txServiceProvider_base) runs on the event loop. Synchronous providers keep
+working unchanged: their blocking doHandleClient() runs in a worker thread
+(adapter), which only exchanges data with the loop through _rx_buffer and
+_tx_buffer, just like with the connection thread of the process mode.
+Async providers (txServiceProvider_async) run as tasks on the loop.
+
+A synchronous provider waiting at a hibernation point (see
+TelexServiceProvider_base.hibernate) is parked: no thread and no slot of
+maxConcurrent while the caller is typing, up to maxHibernated sessions.
+"""
+
+import asyncio
+import collections
+import signal
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+l = logging.getLogger("txs." + __name__)
+
+import txServiceProvider_base as txss_base
+import txsPool
+import txsSystemd
+import txsFrame
+
+END_TIMEOUT = 5   # seconds we wait for the remote to hang up after our End packet
+ACK_INTERVAL = 1.0   # keep-alive Acknowledge while waiting in the admission queue
+
+
+
+class TransportSocket():
+	'''
+	Minimal socket-like wrapper around an asyncio transport, so the send_…
+	methods of the provider can be used unchanged.
+	'''
+	def __init__(self, transport):
+		self._transport = transport
+
+	def sendall(self, data):
+		if self._transport.is_closing():
+			raise BrokenPipeError()
+		self._transport.write(bytes(data))
+
+	def sendmsg(self, buffers) -> int:
+		if self._transport.is_closing():
+			raise BrokenPipeError()
+		self._transport.write(b''.join(buffers))
+		return sum(len(b) for b in buffers)
+
+
+class TelexConnProtocol(asyncio.Protocol):
+	'''i-telex connection on the event loop, drives the protocol part of the provider'''
+
+	def __init__(self, server, service):
+		self._server = server
+		self._service = service   # port the connection came in on (txservice.Service)
+		self._provider = None
+		self._buf = bytearray()     # received before the provider is started (or while paused)
+		self._paused = False        # reading paused, the provider's receive buffer is throttled
+		self._parser = txsFrame.FrameParser()
+		self._alive = False
+		self._ended = False
+		self._provider_running = False
+		self._parked = None         # step while hibernating
+		self._tick_handle = None    # timer for the next deadline of the provider
+		self._tick_deadline = None
+		self._wait_handles = None   # timers while waiting in the admission queue
+		self._dial_handle = None    # timer while waiting for the Direct Dial packet (routing)
+
+	# the provider asks this in is_running() instead of the connection thread
+	def is_alive(self):
+		return self._alive
+
+	def connection_made(self, transport):
+		self._transport = transport
+		self._s = TransportSocket(transport)
+		self._addr = transport.get_extra_info('peername')
+		self._loop = asyncio.get_running_loop()
+		# the provider batches its packets (flush), Nagle would only delay them
+		sock = transport.get_extra_info('socket')
+		if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+		if self._server.acquire(self):
+			self.start()
+			return
+		if self._server.enqueue(self):
+			self._wait()
+			return
+
+		# no capacity: reject
+		try:
+			txss_base.TelexServiceProvider_base.send_reject(self._s, 'occ')
+		except Exception:
+			pass
+		transport.close()
+		l.warning(f"Rejected connection from {self._addr}: max concurrent reached")
+
+	def _wait(self):
+		'''Wait in the admission queue: banner, keep-alive Acknowledges and deadline'''
+		self._wait_start = self._loop.time()
+		try:
+			self._s.sendall(self._server.banner + bytes([6, 1, 0]))   # banner and Acknowledge (nothing printed)
+		except OSError:
+			return
+		self._wait_handles = [
+			self._loop.call_later(ACK_INTERVAL, self._wait_ack),
+			self._loop.call_later(self._server.queueTimeout, self._wait_timeout) ]
+		l.info(f"Connection from {self._addr} queued")
+
+	def _wait_ack(self):
+		try:
+			self._s.sendall(bytes([6, 1, 0]))
+		except OSError:
+			return
+		self._wait_handles[0] = self._loop.call_later(ACK_INTERVAL, self._wait_ack)
+
+	def _wait_timeout(self):
+		self._wait_cancel()
+		self._server.dequeue(self, timeout=True)
+		l.warning(f"Rejected connection from {self._addr}: no free slot within {self._server.queueTimeout} s")
+		try:
+			txss_base.TelexServiceProvider_base.send_reject(self._s, 'occ')
+		except Exception:
+			pass
+		self._transport.close()
+
+	def _wait_overflow(self):
+		# a caller which sends that much while waiting isn't a teleprinter
+		self._wait_cancel()
+		self._server.dequeue(self, overflow=True)
+		self._buf = bytearray()
+		l.warning(f"Rejected connection from {self._addr}: sent more than {txss_base.WAIT_RECEIVE} bytes while waiting")
+		try:
+			txss_base.TelexServiceProvider_base.send_reject(self._s, 'occ')
+		except Exception:
+			pass
+		self._transport.close()
+
+	def _wait_cancel(self):
+		if self._wait_handles:
+			for h in self._wait_handles:
+				h.cancel()
+			self._wait_handles = None
+
+	def start(self, sent=0):
+		'''Start the session; sent: Baudot characters already sent (banner of the admission queue)'''
+		self._wait_cancel()
+		l.info(f"Connection from {self._addr}")
+		self._sent = sent
+		if self._server.routed:
+			# the provider depends on the dialled extension
+			self._dial_handle = self._loop.call_later(txss_base.DIAL_TIMEOUT, self._dialled, None)
+			self.data_received(b'')
+		else:
+			self._dialled(None)
+
+	def _dialled(self, ext):
+		'''Extension known (or none within txss_base.DIAL_TIMEOUT): create the provider and start the protocol'''
+		if self._dial_handle:
+			self._dial_handle.cancel()
+			self._dial_handle = None
+		self._alive = True
+		self._provider = self._server.new_provider(ext, self._service)
+		if self._provider._extension is not None:
+			l.info(f"Extension {ext} routed to {type(self._provider).__module__}")
+		self._provider._stop = self._server.stop
+		self._provider._t = self
+		self._provider._remote = self._addr
+		self._provider._sent_offset = self._sent
+		self._provider._rx_buffer.on_low = self._rx_drained
+		self._provider._tx_buffer.on_data = self._tx_queued
+
+		if not self._call(self._provider.handle_conn_start, self._s):
+			return
+		self._settle()
+
+		self._provider_running = True
+		if self._provider.is_async:
+			# async provider: a task on the loop, no thread while it waits
+			fut = self._loop.create_task(self._provider.run_provider_async())
+		else:
+			# adapter: run the synchronous provider in a worker thread
+			self._provider._park = self._server.can_park
+			fut = self._loop.run_in_executor(self._server.executor, self._provider.run_provider)
+		fut.add_done_callback(self._provider_done)
+
+		# data received while waiting in the admission queue or for the Direct Dial packet
+		if self._buf:
+			self.data_received(b'')
+
+	def data_received(self, data):
+		self._receive(data)
+		if self._alive:
+			if self._parked and self._input_waiting():
+				self._server.unpark(self)
+			self._settle()
+
+	def _receive(self, data):
+		buf = self._buf
+		if not self._alive:
+			if self._wait_handles:
+				buf.extend(data)   # for the provider after admission
+				if len(buf) > txss_base.WAIT_RECEIVE:
+					self._wait_overflow()
+			elif self._dial_handle:
+				buf.extend(data)   # the provider reads it again
+				decided, ext = txss_base.parse_direct_dial(buf)
+				if decided or len(buf) > txss_base.WAIT_RECEIVE:
+					# no Direct Dial in that much: the default provider, which throttles
+					self._dialled(ext)
+			return
+		if buf:
+			data = buf + data
+			self._buf = bytearray()
+		data = memoryview(data)
+		rx = self._provider._rx_buffer
+		while self._alive:
+			# frames left in the parser first (receiving was paused)
+			for kind, frame in self._parser:
+				if kind == txsFrame.ASCII:
+					self._call(self._provider.handle_ascii, self._s, bytes(frame))
+				else:
+					self._call(self._provider.handle_packet, self._s, frame)
+				if not self._alive or rx.throttled:
+					break
+			if not self._alive:
+				return
+			if rx.throttled:
+				# the provider doesn't keep up with reading: keep the rest
+				# and stop receiving, TCP throttles the remote
+				self._buf.extend(data)
+				if not self._paused:
+					self._paused = True
+					self._transport.pause_reading()
+				return
+			if not data:
+				return
+			n = self._parser.feed(data)
+			data = data[n:]
+			self._provider.handle_conn_idle()
+
+	def _input_waiting(self) -> bool:
+		'''Parked: a complete line has arrived, or the receive buffer is full'''
+		rx = self._provider._rx_buffer
+		return '\n' in rx.peek(len(rx)) or rx.throttled
+
+	def resume(self):
+		'''Parked and a slot granted: continue the provider at its hibernation point'''
+		step = self._parked
+		self._parked = None
+		l.info(f"Resuming connection from {self._addr} at {step!r}")
+		self._provider_running = True
+		fut = self._loop.run_in_executor(self._server.executor, self._provider.run_provider, step)
+		fut.add_done_callback(self._provider_done)
+
+	def _rx_drained(self):
+		# from the provider thread: its receive buffer has fallen to the low watermark
+		try:
+			self._loop.call_soon_threadsafe(self._resume_reading)
+		except RuntimeError:
+			pass   # the loop is closed (shutdown)
+
+	def _tx_queued(self):
+		# from the provider thread: characters in its empty output buffer
+		try:
+			self._loop.call_soon_threadsafe(self._tx_ready)
+		except RuntimeError:
+			pass   # the loop is closed (shutdown)
+
+	def _tx_ready(self):
+		if not self._alive:
+			return
+		self._provider.handle_tx_data()
+		self._settle()
+
+	def _resume_reading(self):
+		if not self._paused or not self._alive:
+			return
+		self._paused = False
+		self._transport.resume_reading()
+		self.data_received(b'')
+
+	def eof_received(self):
+		l.warning("Remote has closed connection")
+		self._end()
+
+	def connection_lost(self, exc):
+		if self._dial_handle:
+			self._dial_handle.cancel()
+			self._dial_handle = None
+		if self._wait_handles:
+			self._wait_cancel()
+			self._server.dequeue(self)
+			l.info(f"Waiting connection from {self._addr} hung up")
+		if exc is not None:
+			l.error(f"Connection lost: {exc!r}")
+			if self._provider is not None:
+				self._provider._conn_error = True
+		self._end()
+		self._server.release(self)
+
+	def _call(self, handler, *args) -> bool:
+		'''Call a protocol handler of the provider, returns False if the connection was ended'''
+		try:
+			if handler(*args):
+				self._end()
+		except (socket.error,BrokenPipeError,ConnectionResetError):
+			l.error("Exception caught:", exc_info = True)
+			self._provider._conn_error = True
+			self._end()
+		return self._alive
+
+	def _settle(self):
+		'''Send what the provider has queued, then sleep until its next deadline (Acknowledge, sending, idle timeout)'''
+		if not self._call(self._provider.flush, self._s):
+			return
+		deadline = self._provider.next_deadline()
+		if deadline == self._tick_deadline:
+			return
+		if self._tick_handle:
+			self._tick_handle.cancel()
+			self._tick_handle = None
+		self._tick_deadline = deadline
+		if deadline is not None:
+			clock = self._provider.clock
+			self._tick_handle = self._loop.call_later(clock.timeout(max(0.0, deadline - clock.monotonic())), self._tick)
+
+	def _tick(self):
+		self._tick_handle = None
+		self._tick_deadline = None
+		if not self._alive:
+			return
+		self._provider.handle_conn_idle()
+		if self._call(self._provider.handle_timeout, self._s):
+			self._settle()
+
+	def _provider_done(self, fut):
+		self._provider_running = False
+		step = getattr(self._provider, '_hibernated', None)
+		if step and self._alive:
+			self._parked = step
+			l.info(f"Connection from {self._addr} parked at {step!r}")
+			self._server.park(self)
+			if self._input_waiting():   # arrived while the thread was ending
+				self._server.unpark(self)
+			return
+		if self._alive:
+			self._provider.send_end(self._s)
+			# give the remote the chance to hang up by itself
+			self._loop.call_later(END_TIMEOUT, self._end)
+		self._server.release(self)
+
+	def _end(self):
+		if self._ended or self._provider is None:
+			return
+		self._ended = True
+		self._alive = False
+		if self._tick_handle:
+			self._tick_handle.cancel()
+			self._tick_handle = None
+		if not self._transport.is_closing():
+			self._provider.handle_conn_end(self._s)
+			self._transport.close()
+		self._provider.conn_closed()
+
+	def finished(self) -> bool:
+		'''Connection is ended and the provider has returned'''
+		return (self._ended or self._provider is None) and not self._provider_running
+
+	def parked(self) -> bool:
+		return self._parked is not None
+
+	def close(self):
+		'''Server is shutting down'''
+		self._wait_cancel()
+		if self._dial_handle:
+			self._dial_handle.cancel()
+			self._dial_handle = None
+		if self._provider is None:
+			self._transport.close()
+		self._end()
+
+
+class TelexAsyncServer():
+
+	def __init__(self, config, providerFactory, services, successor=True, routed=False):
+		self._config = config
+		self.new_provider = providerFactory   # new_provider(ext, service): provider for the dialled extension or the service
+		self.routed = routed   # several services behind a port, chosen by the Direct Dial extension
+		self._services = services   # services with their listening sockets (txservice.Service)
+		self._successor = successor   # SIGHUP: start a new master which takes over the sockets
+		self._draining = False
+		self._maxConcurrent = int(config['server']['maxConcurrent'])
+		self._conns = set()
+		self.acceptNew = True
+		# admission queue: connections waiting for a free slot
+		self._queue = collections.deque()
+		self._maxWaiting = int(config['server']['maxWaiting'])
+		# parked sessions (hibernation) and those of them with a line to go on with
+		self._parked = set()
+		self._resuming = collections.deque()
+		self._maxHibernated = int(config['server']['maxHibernated'])
+		self.queueTimeout = float(config['server']['queueTimeout'])
+		banner = config['server']['queueBanner']
+		self.banner, self._banner_len = txss_base.encode_baudot_packets(banner) if banner else (b'', 0)
+		self._q_max_depth = 0
+		self._q_served = 0
+		self._q_timeouts = 0
+		self._q_abandoned = 0
+		self._q_overflows = 0
+		self._q_wait_total = 0.0
+		self._q_wait_max = 0.0
+		# stop event for the provider threads (see is_running())
+		self.stop = threading.Event()
+		# the adapter needs one thread per running synchronous provider
+		self.executor = ThreadPoolExecutor(max_workers=self._maxConcurrent, thread_name_prefix='txsProvider')
+
+	def _admissible(self, conn) -> bool:
+		# shared budget and the limit of the service
+		return len(self._conns) < self._maxConcurrent and conn._service.available()
+
+	# a slot is held until the connection is closed AND the provider thread has returned
+	def acquire(self, conn) -> bool:
+		if not self.acceptNew or not self._admissible(conn) or any(self._admissible(c) for c in self._queue):
+			return False
+		self._conns.add(conn)
+		conn._service.active += 1
+		return True
+
+	def release(self, conn):
+		if conn in self._parked and conn.finished():
+			# hung up while parked
+			self._parked.discard(conn)
+			if conn in self._resuming:
+				self._resuming.remove(conn)
+			self._check_drained()
+		elif conn in self._conns and conn.finished():
+			self._conns.discard(conn)
+			conn._service.active -= 1
+			self._admit()
+			self._check_drained()
+
+	def _admit(self):
+		'''Give free slots to parked sessions with a line first, then to the longest waiting connections (which their service admits)'''
+		while True:
+			conn = next((c for c in self._resuming if self._admissible(c)), None)
+			if conn is None:
+				break
+			self._resuming.remove(conn)
+			self._resume(conn)
+		while True:
+			conn = next((c for c in self._queue if self._admissible(c)), None)
+			if conn is None:
+				break
+			self._queue.remove(conn)
+			wait = asyncio.get_running_loop().time() - conn._wait_start
+			self._q_served += 1
+			self._q_wait_total += wait
+			self._q_wait_max = max(self._q_wait_max, wait)
+			l.info(f"Connection from {conn._addr} admitted after waiting {wait:.1f} s")
+			self._conns.add(conn)
+			conn._service.active += 1
+			conn.start(self._banner_len)
+
+	# hibernation: a parked session holds no slot
+	def can_park(self) -> bool:
+		'''(from a provider thread) room for one more parked session'''
+		return len(self._parked) < self._maxHibernated
+
+	def park(self, conn):
+		self._conns.discard(conn)
+		conn._service.active -= 1
+		self._parked.add(conn)
+		self._admit()
+
+	def unpark(self, conn):
+		'''A parked session has got a line: resume it as soon as there is a slot'''
+		if conn in self._resuming:
+			return
+		if self._admissible(conn) and not self._resuming:
+			self._resume(conn)
+		else:
+			self._resuming.append(conn)
+
+	def _resume(self, conn):
+		self._parked.discard(conn)
+		self._conns.add(conn)
+		conn._service.active += 1
+		conn.resume()
+
+	def enqueue(self, conn) -> bool:
+		if not self.acceptNew or len(self._queue) >= self._maxWaiting:
+			return False
+		self._queue.append(conn)
+		self._q_max_depth = max(self._q_max_depth, len(self._queue))
+		return True
+
+	def dequeue(self, conn, timeout=False, overflow=False):
+		if conn in self._queue:
+			self._queue.remove(conn)
+			if timeout:
+				self._q_timeouts += 1
+			elif overflow:
+				self._q_overflows += 1
+			else:
+				self._q_abandoned += 1
+			self._check_drained()
+
+	def queue_stats(self) -> str:
+		avg = self._q_wait_total / self._q_served if self._q_served else 0
+		return (f"queue: {len(self._queue)} waiting (max {self._q_max_depth}), {self._q_served} served "
+			f"(wait avg {avg:.1f} s, max {self._q_wait_max:.1f} s), {self._q_timeouts} timed out, {self._q_abandoned} hung up, "
+			f"{self._q_overflows} sent too much")
+
+	def active(self) -> int:
+		return len(self._conns)
+
+	def parked(self) -> int:
+		return len(self._parked)
+
+	def _check_drained(self):
+		# after the handover (SIGHUP) we end as soon as the last connection has ended
+		if self._draining and not self._conns and not self._queue and not self._parked:
+			self._shutdown.set()
+
+	async def serve(self):
+		loop = asyncio.get_running_loop()
+		shutdown = self._shutdown = asyncio.Event()
+		watchdog = txsSystemd.Watchdog()
+		servers = []
+
+		# stops all active connections and comes to an end
+		def _signal_handler_term():
+			l.info("Signal received, shutting down...")
+			shutdown.set()
+		# get count of currently connected connections
+		def _signal_handler_getconn():
+			l.info(str(self.active()) + " Currently Active Connections <---------------------------------------")
+			l.info(self.queue_stats())
+			print(self.active())
+			print(self.queue_stats())
+			if self._maxHibernated:
+				l.info(f"{self.parked()} parked (hibernating) connections")
+				print(f"{self.parked()} parked")
+			if len(self._services) > 1:
+				services = ", ".join(f"{svc.name or 'default'}: {svc.active}" for svc in self._services)
+				l.info("Active connections per service: " + services)
+				print(services)
+		# stop accepting new connection, so we can give active connections a chance
+		# to get finished without be ended while do long requests
+		def _signal_handler_stopaccept():
+			l.info("Signal received, dont accept anymore...")
+			self.acceptNew = False
+		# hand the listening sockets over to a new master and serve our connections to their end
+		def _signal_handler_hup():
+			if self._draining:
+				return
+			self._draining = True
+			self.acceptNew = False
+			if self._successor:
+				pid = txsPool.spawn_successor([svc.sock for svc in self._services])
+				l.info(f"SIGHUP: new master {pid} takes over the listening sockets, serving {self.active()} active connections to their end")
+				txsSystemd.notify(f"MAINPID={pid}")
+				watchdog.close()
+			for server in servers:
+				server.close()
+			self._check_drained()
+
+		loop.add_signal_handler(signal.SIGINT, _signal_handler_term)
+		loop.add_signal_handler(signal.SIGTERM, _signal_handler_term)
+		loop.add_signal_handler(signal.SIGUSR1, _signal_handler_getconn)     # USR1 - Get current connection count
+		loop.add_signal_handler(signal.SIGUSR2, _signal_handler_stopaccept)  # USR2 - Stop accepting new connections
+		loop.add_signal_handler(signal.SIGHUP, _signal_handler_hup)          # HUP  - Restart without dropping calls
+
+		for svc in self._services:
+			servers.append(await loop.create_server(lambda svc=svc: TelexConnProtocol(self, svc),
+				sock=svc.sock, backlog=int(self._config['server']['listenBacklog'])))
+			l.info(f"Server (asyncio) listening on port {svc.sock.getsockname()[1]} for service {svc}")
+		l.info(f"max {self._maxConcurrent} concurrent handlers")
+
+		# systemd: ready, and keep-alive pings from the event loop
+		def _watchdog_ping():
+			if watchdog:
+				watchdog.ping()
+				loop.call_later(watchdog.timeout(), _watchdog_ping)
+		_watchdog_ping()
+		txsSystemd.notify(f"READY=1\nSTATUS=Listening on port {', '.join(str(svc.sock.getsockname()[1]) for svc in self._services)}")
+
+		try:
+			await shutdown.wait()
+		finally:
+			print("Closing server socket and ending connections...")
+			if not self._draining:
+				txsSystemd.notify("STOPPING=1")
+			for server in servers:
+				server.close()
+			self.stop.set()
+			for conn in list(self._conns) + list(self._queue) + list(self._parked):
+				conn.close()
+			# provider threads see stop and return by themselves
+			self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main(config, providerFactory, services, successor=True, routed=False):
+	server = TelexAsyncServer(config, providerFactory, services, successor, routed)
+	asyncio.run(server.serve())
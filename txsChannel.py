@@ -0,0 +1,206 @@
+#!/bin/env python3
+"""
+Telex Service - character channel between protocol and provider
+
+The protocol side (connection thread or asyncio loop) and the provider
+thread exchange characters through two channels, _rx_buffer and _tx_buffer
+of the provider. All waiting is done on a Condition: a provider blocked in
+get() wakes up the moment the protocol side puts a character, and at once
+when the connection is closed.
+
+A channel is a bounded ring buffer of characters (UTF-32, 4 bytes each)
+with a high and a low watermark. The ring starts with MIN_CAPACITY
+characters, grows as needed up to the size of the channel and shrinks back
+when the channel is empty, an idle session keeps only a small ring. Above the high watermark it is throttled
+until it has fallen to the low watermark again: a blocking put() waits (the
+provider in send()), the protocol side stops receiving from the remote.
+
+A side which can't block a thread (the asyncio core, async providers)
+waits for the on_… callbacks instead of the Condition.
+"""
+
+import threading
+
+import logging
+l = logging.getLogger("txs." + __name__)
+
+ENCODING = 'utf-32-le'
+MIN_CAPACITY = 64   # characters the ring has at least
+
+
+class Channel():
+
+	def __init__(self, size:int=4096, high:int=None, low:int=None):
+		self._size = size
+		self._high = size if high is None else min(high, size)
+		self._low = self._high // 2 if low is None else min(low, self._high)
+		self._cap = min(MIN_CAPACITY, size)   # characters the ring has room for
+		self._ring = bytearray(4 * self._cap)
+		self._head = 0   # position of the first character
+		self._len = 0
+		self._throttled = False
+		self._resume = False   # on_low is due
+		self._emptied = False  # on_empty is due
+		self._cond = threading.Condition()
+		self._closed = False
+		self.on_low = None   # called when the channel is no longer throttled (from the reading thread)
+		self.on_data = None  # called when characters arrive in the empty channel (from the writing thread, lock held: must not touch the channel)
+		self.on_empty = None # called when the last character has been taken (from the reading thread)
+		self.on_close = None # called when the channel is closed
+
+	def __len__(self):
+		return self._len
+
+	@property
+	def closed(self) -> bool:
+		return self._closed
+
+	@property
+	def throttled(self) -> bool:
+		'''Above the high watermark and not yet fallen to the low watermark'''
+		return self._throttled
+
+	def put(self, chars:str, block:bool=True) -> int:
+		'''
+		Append chars and wake up the waiting side, returns the count of
+		characters taken. block: wait while throttled (never on a closed
+		channel), else take as much as fits.
+		'''
+		done = 0
+		with self._cond:
+			was_empty = not self._len
+			while done < len(chars) and not self._closed:
+				if block:
+					self._cond.wait_for(lambda: not self._throttled or self._closed)
+					if self._closed:
+						break
+				n = min(len(chars) - done, self._size - self._len)
+				if not n:
+					break
+				self._write(chars[done:done+n])
+				done += n
+				self._cond.notify_all()
+				if was_empty and self.on_data:
+					self.on_data()
+					was_empty = False
+		return done
+
+	def get(self, timeout=None) -> str:
+		'''Next character, waits for it; None on timeout or if closed and empty'''
+		with self._cond:
+			self._cond.wait_for(lambda: self._len or self._closed, timeout)
+			if not self._len:
+				return None
+			c = self._read(1)
+		self._resumed()
+		return c
+
+	def get_nowait(self) -> str:
+		'''Next character, None if there is none'''
+		return self.take(1) or None
+
+	def take(self, n:int) -> str:
+		'''Up to n characters without waiting'''
+		with self._cond:
+			chars = self._read(n)
+		self._resumed()
+		return chars
+
+	def clear(self):
+		with self._cond:
+			self._read(self._len)
+		self._resumed()
+
+	def wait_for(self, predicate, timeout=None) -> bool:
+		'''Wait until predicate() is true (it is called with the lock held), False on timeout or close'''
+		with self._cond:
+			self._cond.wait_for(lambda: predicate() or self._closed, timeout)
+			return predicate()
+
+	def wait_empty(self, timeout=None) -> bool:
+		'''Wait until all characters are taken, False on timeout or close'''
+		return self.wait_for(lambda: not self._len, timeout)
+
+	def wait_writable(self, timeout=None) -> bool:
+		'''Wait until the channel is no longer throttled, False on timeout or close'''
+		return self.wait_for(lambda: not self._throttled, timeout)
+
+	def close(self):
+		'''The connection is over: wake up everybody who waits'''
+		with self._cond:
+			self._closed = True
+			self._cond.notify_all()
+		if self.on_close:
+			self.on_close()
+
+	def _write(self, chars:str):
+		# lock held, chars fit
+		data = chars.encode(ENCODING, 'surrogatepass')
+		n = len(data) // 4
+		if self._len + n > self._cap:
+			self._resize(self._len + n)
+		pos = (self._head + self._len) % self._cap
+		first = min(n, self._cap - pos)
+		self._ring[4*pos:4*(pos+first)] = data[:4*first]
+		self._ring[:4*(n-first)] = data[4*first:]
+		self._len += n
+		if self._len >= self._high:
+			self._throttled = True
+
+	def peek(self, n:int) -> str:
+		'''Up to n characters without taking them (for the only reading side)'''
+		with self._cond:
+			return self._peek(n)
+
+	def _peek(self, n:int) -> str:
+		# lock held
+		n = min(n, self._len)
+		pos = self._head
+		first = min(n, self._cap - pos)
+		data = self._ring[4*pos:4*(pos+first)]
+		if first < n:
+			data += self._ring[:4*(n-first)]
+		return data.decode(ENCODING, 'surrogatepass')
+
+	def _read(self, n:int) -> str:
+		# lock held
+		n = min(n, self._len)
+		if not n:
+			return ''
+		chars = self._peek(n)
+		self._head = (self._head + n) % self._cap
+		self._len -= n
+		if self._throttled and self._len <= self._low:
+			self._throttled = False
+			self._resume = True
+		if not self._len:
+			self._emptied = True
+			if self._cap > MIN_CAPACITY:
+				self._resize(0)
+		self._cond.notify_all()
+		return chars
+
+	def _resize(self, n:int):
+		# lock held: a ring for at least n characters (doubling, at most size), the characters start at 0
+		cap = min(MIN_CAPACITY, self._size)
+		while cap < n:
+			cap *= 2
+		cap = min(cap, self._size)
+		ring = bytearray(4 * cap)
+		first = min(self._len, self._cap - self._head)
+		ring[:4*first] = self._ring[4*self._head:4*(self._head+first)]
+		ring[4*first:4*self._len] = self._ring[:4*(self._len-first)]
+		self._ring = ring
+		self._cap = cap
+		self._head = 0
+
+	def _resumed(self):
+		# outside the lock: tell the writing side that it may go on
+		if self._resume:
+			self._resume = False
+			if self.on_low:
+				self.on_low()
+		if self._emptied:
+			self._emptied = False
+			if self.on_empty:
+				self.on_empty()
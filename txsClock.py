@@ -0,0 +1,113 @@
+#!/bin/env python3
+"""
+Telex Service - clock of the protocol and the providers
+
+All timing of a connection (pacing of the flow control, Acknowledge
+schedule, WRU timeout, period of the protocol loop, loop-back of
+txCode.BaudotMurrayCode) reads the clock of the provider class
+(TelexServiceProvider_base.clock) instead of the time module. A clock has
+monotonic(), time() and sleep() like the time module, and timeout(),
+which converts a duration of the clock into real seconds for waiting on
+sockets, conditions and the event loop.
+
+- RealClock: the time module (default)
+- ScaledClock: time runs factor times faster, all waiting is shortened
+  accordingly. A whole server with real sockets and threads runs like
+  this ([server] timeScale), e.g. with bench/loadgen.py --time-scale.
+
+Timers holds the deadlines of a connection (Acknowledge, sending,
+idle timeout) in clock time, the protocol loop sleeps until the next one.
+"""
+
+import time
+import heapq
+
+
+class RealClock():
+	scale = 1.0
+
+	def monotonic(self) -> float:
+		return time.monotonic()
+
+	def time(self) -> float:
+		return time.time()
+
+	def sleep(self, seconds:float):
+		time.sleep(seconds)
+
+	def timeout(self, seconds:float) -> float:
+		'''Real seconds to wait for a duration of seconds on this clock (None: forever)'''
+		return seconds
+
+
+class ScaledClock(RealClock):
+	'''Time runs factor times faster than real time (starting now)'''
+
+	def __init__(self, factor:float):
+		if factor <= 0:
+			raise ValueError(f"time scale must be positive, not {factor}")
+		self.scale = float(factor)
+		self._real0 = time.monotonic()
+		self._wall0 = time.time()
+
+	def _elapsed(self) -> float:
+		return (time.monotonic() - self._real0) * self.scale
+
+	def monotonic(self) -> float:
+		return self._real0 + self._elapsed()
+
+	def time(self) -> float:
+		return self._wall0 + self._elapsed()
+
+	def sleep(self, seconds:float):
+		time.sleep(seconds / self.scale)
+
+	def timeout(self, seconds:float) -> float:
+		return None if seconds is None else seconds / self.scale
+
+
+REAL = RealClock()
+
+
+class Timers():
+	'''Named deadlines (clock time) in a heap, each name at most once'''
+
+	def __init__(self):
+		self._heap = []
+		self._due = {}   # name -> deadline, heap entries not matching are outdated
+
+	def __contains__(self, name) -> bool:
+		return name in self._due
+
+	def schedule(self, name:str, when:float):
+		'''Set the deadline of name (replaces an earlier one)'''
+		if self._due.get(name) == when:
+			return
+		self._due[name] = when
+		heapq.heappush(self._heap, (when, name))
+
+	def schedule_before(self, name:str, when:float):
+		'''Set the deadline of name unless it is due earlier already'''
+		if name not in self._due or when < self._due[name]:
+			self.schedule(name, when)
+
+	def cancel(self, name:str):
+		self._due.pop(name, None)
+
+	def next(self) -> float:
+		'''The earliest deadline, None if there is none'''
+		heap = self._heap
+		while heap and self._due.get(heap[0][1]) != heap[0][0]:
+			heapq.heappop(heap)
+		return heap[0][0] if heap else None
+
+	def pop_due(self, now:float) -> list:
+		'''Names whose deadline has come, earliest first (they are removed)'''
+		names = []
+		while True:
+			t = self.next()
+			if t is None or t > now:
+				return names
+			name = heapq.heappop(self._heap)[1]
+			del self._due[name]
+			names.append(name)
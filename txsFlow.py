@@ -0,0 +1,95 @@
+#!/bin/env python3
+"""
+Telex Service - flow control of the Baudot data we send
+
+The remote acknowledges the characters it has printed with an 8 bit
+counter. AckWindow keeps absolute sent/printed counters (the 8 bit value is
+unambiguous as long as less than 256 characters are unprinted, which the
+window guarantees), measures the print rate of the remote from the timing
+of its Acknowledges and tells the protocol loop how many characters it may
+send now: enough to keep the printer busy until the next Acknowledge, but
+never more than the remote can buffer.
+
+A teleprinter prints about 6.7 characters per second (50 Bd); a software
+client prints "instantly" and acknowledges at once, its estimated rate
+grows until the window is the limit.
+"""
+
+import logging
+l = logging.getLogger("txs." + __name__)
+
+DEFAULT_RATE = 1 / 0.15   # characters per second of a 50 Bd teleprinter
+MIN_RATE = 1.0
+MAX_RATE = 2000.0
+ALPHA = 0.25        # weight of a new sample in the rate estimation (EWMA)
+LEAD = 3.0          # seconds of printing we keep in flight (Acknowledge about every second)
+MIN_WINDOW = 7      # always allowed in flight (about one second of printing)
+MAX_WINDOW = 128    # never more unprinted characters than this (< 256, remote buffer)
+
+
+class AckWindow():
+
+	def __init__(self, sent:int=0, now:float=0.0, rate:float=DEFAULT_RATE):
+		self.sent = sent        # characters sent, absolute
+		self.printed = 0        # characters printed by the remote, absolute
+		self.rate = rate        # estimated print rate of the remote (characters/s)
+		self._t_ack = now       # time of the last Acknowledge
+		self._t_printed = now   # time the printer has (according to the estimate) been busy since
+
+	@property
+	def unprinted(self) -> int:
+		'''Characters sent and not yet acknowledged as printed'''
+		return self.sent - self.printed
+
+	def on_sent(self, n:int, now:float):
+		if not n:
+			return
+		if self.sent == self.printed_estimate(now):
+			# printer was idle: the printing of this data starts now
+			self._t_printed = now
+		self.sent += n
+
+	def on_ack(self, counter:int, now:float):
+		'''Acknowledge packet received, counter: printed characters (8 bit)'''
+		printed = self.sent - ((self.sent - counter) & 0xff)
+		if printed < self.printed:
+			l.debug(f"Stale Acknowledge {counter} ({printed} < {self.printed})")
+			return
+		busy = self.unprinted > 0    # printer had something to do since the last Acknowledge
+		done = printed - self.printed
+		dt = now - max(self._t_ack, self._t_printed)
+		self.printed = printed
+		self._t_ack = now
+
+		if busy and done and dt > 0:
+			sample = done / dt
+			if self.unprinted or sample > self.rate:
+				# printer busy the whole time: a measurement; otherwise it was
+				# idle for part of dt and the sample is only a lower bound
+				self.rate += ALPHA * (sample - self.rate)
+				self.rate = min(MAX_RATE, max(MIN_RATE, self.rate))
+		l.debug(f"Acknowledge {counter}: printed {self.printed}/{self.sent}, rate {self.rate:.1f}/s")
+
+	def printed_estimate(self, now:float) -> int:
+		'''Characters printed by now according to the rate estimate'''
+		t0 = max(self._t_ack, self._t_printed)
+		return min(self.sent, self.printed + int(self.rate * max(0.0, now - t0)))
+
+	def window(self) -> int:
+		'''Characters to keep in flight for the estimated rate'''
+		return min(MAX_WINDOW, max(MIN_WINDOW, int(self.rate * LEAD)))
+
+	def budget(self, now:float) -> int:
+		'''Characters which may be sent now'''
+		in_flight = self.sent - self.printed_estimate(now)
+		return max(0, min(self.window() - in_flight, MAX_WINDOW - self.unprinted))
+
+	def next_send(self, now:float) -> float:
+		'''Time from which budget() is positive, None if only an Acknowledge can open the window'''
+		if self.unprinted >= MAX_WINDOW:
+			return None
+		need = self.sent - self.window() + 1 - self.printed   # characters to be printed by then
+		if need <= 0:
+			return now
+		t0 = max(self._t_ack, self._t_printed)
+		return max(now, t0 + (need + 1e-6) / self.rate)
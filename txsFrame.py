@@ -0,0 +1,118 @@
+#!/bin/env python3
+"""
+Telex Service - incremental i-Telex frame parser
+
+FrameParser takes the received bytes in chunks of any size, from a socket
+with recv_into() into its preallocated buffer (threaded protocol loop) or
+with feed() (asyncio core), and yields the complete frames as memoryview
+slices of its buffer:
+- i-Telex packets (type, length, payload), kind = packet type
+- runs of ASCII characters (at most ASCII_RUN), kind = ASCII
+Telnet control sequences are skipped. A packet header with a length which
+is impossible for its type is garbage: the type byte is dropped and the
+parser resyncs at the next byte.
+
+The slices are only valid until the next recv_into() or feed().
+"""
+
+from itertools import chain
+
+import logging
+l = logging.getLogger("txs." + __name__)
+
+# i-Telex packet types (same as txServiceProvider_base.allowed_types),
+# every other byte is an ASCII character
+PACKET_TYPES = frozenset(chain(range(0x00, 0x09+1), range(0x10, 0x1f+1)))
+
+# longest possible payload of the packet types, a longer one is garbage
+MAX_LEN = {
+	0: 0,    # Heartbeat
+	1: 1,    # Direct Dial
+	2: 50,   # Baudot data
+	3: 0,    # End
+	4: 20,   # Reject
+	6: 1,    # Acknowledge
+	7: 20,   # Version
+}
+
+ASCII = -1
+TELNET_IAC = 255
+
+# longest run of ASCII characters in one frame: bounds what a single frame
+# adds to the receive buffer of the provider (a character may expand to 6)
+ASCII_RUN = 256
+
+
+class FrameParser():
+
+	def __init__(self, size:int=4096):
+		self._buf = bytearray(size)
+		self._view = memoryview(self._buf)
+		self._start = 0   # first byte not parsed yet
+		self._end = 0     # end of the received data
+		self.garbage = 0  # bytes dropped while resyncing
+
+	def __len__(self):
+		'''Count of received bytes which are not parsed yet (incomplete frame)'''
+		return self._end - self._start
+
+	def recv_into(self, s) -> int:
+		'''Receive from socket s into the free part of the buffer, returns the count of bytes (0: closed)'''
+		self._compact()
+		n = s.recv_into(self._view[self._end:])
+		self._end += n
+		return n
+
+	def feed(self, data) -> int:
+		'''Copy data into the free part of the buffer, returns the count of bytes taken'''
+		self._compact()
+		n = min(len(data), len(self._buf) - self._end)
+		self._view[self._end:self._end+n] = data[:n]
+		self._end += n
+		return n
+
+	def __iter__(self):
+		'''Yield (kind, frame) for every complete frame received so far'''
+		buf = self._buf
+		while self._start < self._end:
+			pos = self._start
+			t = buf[pos]
+
+			# Telnet control sequence
+			if t == TELNET_IAC:
+				if self._end - pos < 3:
+					return
+				self._start = pos + 3
+
+			# i-Telex packet
+			elif t in PACKET_TYPES:
+				if self._end - pos < 2:
+					return
+				n = buf[pos+1]
+				if n > MAX_LEN.get(t, 255):
+					# no packet header: drop the type byte and resync
+					self._start = pos + 1
+					self.garbage += 1
+					l.debug(f"Garbage byte {t:#x} (length {n}) dropped")
+					continue
+				if self._end - pos < 2 + n:
+					return
+				self._start = pos + 2 + n
+				yield t, self._view[pos:self._start]
+
+			# ASCII characters up to the next packet or telnet sequence
+			else:
+				end = pos + 1
+				last = min(self._end, pos + ASCII_RUN)
+				while end < last and buf[end] != TELNET_IAC and buf[end] not in PACKET_TYPES:
+					end += 1
+				self._start = end
+				yield ASCII, self._view[pos:end]
+
+	def _compact(self):
+		# move the incomplete frame to the start of the buffer
+		if self._start:
+			n = self._end - self._start
+			self._buf[:n] = self._buf[self._start:self._end]
+			self._start = 0
+			self._end = n
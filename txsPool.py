@@ -0,0 +1,188 @@
+#!/bin/env python3
+"""
+Child processes of txservice (process mode)
+
+fork_child() starts a child process; the master reaps all its children
+itself (SIGCHLD and os.waitpid), so no multiprocessing.Process is used.
+spawn_successor() starts the new master on SIGHUP.
+
+WorkerPool is a pre-forked pool of warm worker processes. The workers are
+forked from the master after the provider module (and its heavy imports like
+requests) is loaded. Each worker creates its provider object in advance and
+then waits until the master passes an accepted connection over a unix socket
+(SCM_RIGHTS). A worker handles exactly one connection like the process
+started per connection does. The master forks the replacements one per
+pass of its loop, after the pending connections have been dispatched. After
+an idle worker has died (e.g. its provider can't be created), no worker is
+forked for RESTART_DELAY seconds, the calls get a process of their own.
+"""
+
+import os
+import sys
+import socket
+import threading
+import time
+import traceback
+
+import logging
+l = logging.getLogger("txs." + __name__)
+
+RESTART_DELAY = 1.0   # seconds without forking after an idle worker has died
+
+
+def fork_child(target, *args) -> int:
+	'''Fork a child process which runs target(*args) and exits, returns its pid'''
+	pid = os.fork()
+	if pid:
+		return pid
+
+	# child
+	exitcode = 0
+	try:
+		target(*args)
+	except SystemExit as e:
+		exitcode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+	except BaseException:
+		exitcode = 1
+		l.critical("".join(traceback.format_exc()))
+	finally:
+		try:
+			# like multiprocessing: wait for the other (non daemon) threads, e.g. txsConn
+			for t in threading.enumerate():
+				if t is not threading.current_thread() and not t.daemon:
+					t.join()
+			sys.stdout.flush()
+			sys.stderr.flush()
+		finally:
+			# never return into the loop of the master
+			os._exit(exitcode)
+
+
+def spawn_successor(socks:list=None, groups:list=None) -> int:
+	'''
+	Start a new master with our command line (SIGHUP), it inherits the
+	listening sockets socks (environment TXS_LISTEN_FD), or the ones of every
+	listener process, groups (TXS_LISTENER_FDS). Returns its pid.
+	'''
+	env = dict(os.environ)
+	env.pop('TXS_LISTEN_FD', None)
+	env.pop('TXS_LISTENER_FDS', None)
+	env.pop('WATCHDOG_PID', None)   # the new master becomes the main process of the service
+	if socks:
+		for sock in socks:
+			os.set_inheritable(sock.fileno(), True)
+		env['TXS_LISTEN_FD'] = ','.join(str(sock.fileno()) for sock in socks)
+	if groups:
+		for sock in (sock for group in groups for sock in group):
+			os.set_inheritable(sock.fileno(), True)
+		env['TXS_LISTENER_FDS'] = ';'.join(','.join(str(sock.fileno()) for sock in group) for group in groups)
+	argv = [sys.executable] + sys.argv
+	# the new master starts with a clean signal mask (the supervisor blocks signals)
+	return os.posix_spawn(sys.executable, argv, env, setsigmask=())
+
+
+class WorkerPool():
+
+	def __init__(self, size:int, providerFactory, stop, childInit=None, route=None):
+		self._size = size
+		self._providerFactory = providerFactory
+		self._stop = stop
+		self._childInit = childInit
+		self._route = route   # route(txss, conn, service): provider for the dialled extension or service
+		self._idle = {}   # pid -> channel to the worker (dict keeps the order of forking)
+		self._retry = 0.0   # monotonic time from which workers are forked again
+
+	def __len__(self):
+		return len(self._idle)
+
+	def fill(self, limit:int=None):
+		'''Fork new workers until the pool is full again, at most limit of them'''
+		if time.monotonic() < self._retry:
+			return
+		while len(self._idle) < self._size and limit != 0 and not self._stop.is_set():
+			ch, worker_ch = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+			pid = fork_child(self._worker_main, worker_ch, ch)
+			worker_ch.close()
+			self._idle[pid] = ch
+			if limit is not None:
+				limit -= 1
+
+	def timeout(self):
+		'''Seconds until fill() can fork a missing worker, None if none is missing'''
+		if len(self._idle) >= self._size or self._stop.is_set():
+			return None
+		return max(0, self._retry - time.monotonic())
+
+	def reaped(self, pid:int) -> bool:
+		'''The master has reaped pid, returns True if it was an idle worker'''
+		ch = self._idle.pop(pid, None)
+		if ch is None:
+			return False
+		l.warning(f"Idle worker {pid} died, no new workers for {RESTART_DELAY} s")
+		ch.close()
+		self._retry = time.monotonic() + RESTART_DELAY
+		return True
+
+	def handoff(self, conn:socket.socket, addr, sent:int=0, service:str='', received:bytes=b''):
+		'''
+		Pass an accepted connection to an idle worker (received: what the
+		caller has sent while waiting).
+		Returns the pid of the worker, or None if there is no idle worker.
+		'''
+		while self._idle:
+			pid = next(iter(self._idle))
+			ch = self._idle.pop(pid)
+			try:
+				socket.send_fds(ch, [f"{addr[0]} {addr[1]} {sent} {service}\n".encode()], [conn.fileno()])
+				ch.sendall(received)
+				return pid
+			except OSError:
+				l.warning(f"Handoff to worker {pid} failed", exc_info = True)
+			finally:
+				ch.close()
+		return None
+
+	def close(self) -> list:
+		'''Let the idle workers exit, returns their pids'''
+		for ch in self._idle.values():
+			ch.close()   # worker gets EOF instead of a connection
+		pids = list(self._idle)
+		self._idle = {}
+		return pids
+
+	def _worker_main(self, ch:socket.socket, master_ch:socket.socket):
+		if self._childInit:
+			self._childInit()
+
+		# only the master may hold the other ends, else a worker won't get
+		# an EOF if the master closes its channel
+		master_ch.close()
+		for mch in self._idle.values():
+			mch.close()
+
+		# pre-initialise the provider while we are waiting
+		txss = self._providerFactory()
+
+		try:
+			msg, fds, flags, _ = socket.recv_fds(ch, 256, 1)
+			# then what the caller has sent while waiting, up to the EOF
+			while fds:
+				data = ch.recv(4096)
+				if not data:
+					break
+				msg += data
+		except OSError:
+			return
+		finally:
+			ch.close()
+		if not fds:
+			return   # pool closed
+
+		conn = socket.socket(fileno=fds[0])
+		head, received = msg.split(b'\n', 1)
+		host, port, sent, service = head.decode().split(' ', 3)
+		txss._sent_offset = int(sent)   # banner of the admission queue
+		txss._received = received
+		if self._route:
+			txss = self._route(txss, conn, service)
+		txss.handle_client(conn, (host, int(port)), None, self._stop)
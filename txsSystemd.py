@@ -0,0 +1,101 @@
+#!/bin/env python3
+"""
+systemd integration of txservice without any extra dependency
+
+- socket activation: listening sockets passed with LISTEN_FDS/LISTEN_PID
+- sd_notify: READY=1, RELOADING=1, STOPPING=1, MAINPID=…, STATUS=…
+- watchdog: WATCHDOG=1 pings, at half of WatchdogSec
+
+Everything is a no-op if the server isn't started by systemd.
+"""
+
+import os
+import socket
+import time
+
+import logging
+l = logging.getLogger("txs." + __name__)
+
+SD_LISTEN_FDS_START = 3
+
+
+def listen_fds() -> list:
+	'''Listening sockets passed by systemd (socket activation), empty list if none'''
+	try:
+		if int(os.environ.get('LISTEN_PID', '0')) != os.getpid():
+			return []
+		n = int(os.environ.get('LISTEN_FDS', '0'))
+	except ValueError:
+		return []
+	finally:
+		# not for our children
+		for var in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+			os.environ.pop(var, None)
+
+	socks = []
+	for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + n):
+		os.set_inheritable(fd, False)
+		socks.append(socket.socket(fileno=fd))
+	return socks
+
+
+def notify(state:str) -> bool:
+	'''Send state to the service manager, returns False if not started by systemd'''
+	addr = os.environ.get('NOTIFY_SOCKET')
+	if not addr:
+		return False
+	if addr[0] == '@':
+		addr = '\0' + addr[1:]   # abstract namespace
+	try:
+		with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as s:
+			s.sendto(state.encode(), addr)
+		return True
+	except OSError:
+		l.warning(f"sd_notify {state!r} failed", exc_info = True)
+		return False
+
+
+def detach():
+	'''This process (e.g. a listener of the supervisor) doesn't talk to systemd itself'''
+	for var in ('NOTIFY_SOCKET', 'WATCHDOG_USEC', 'WATCHDOG_PID'):
+		os.environ.pop(var, None)
+
+
+class Watchdog():
+	'''
+	Keep-alive pings for WatchdogSec= of the unit. The master calls ping()
+	from its loop and includes timeout() in its select timeout, so a hung
+	loop stops the pings and systemd restarts the service.
+	'''
+	def __init__(self):
+		self.interval = None
+		try:
+			usec = int(os.environ.get('WATCHDOG_USEC', '0'))
+			pid = int(os.environ.get('WATCHDOG_PID', str(os.getpid())))
+		except ValueError:
+			usec = 0
+			pid = 0
+		if usec > 0 and pid == os.getpid():
+			self.interval = usec / 1e6 / 2
+		self._next = time.monotonic()
+
+	def __bool__(self):
+		return self.interval is not None
+
+	def timeout(self):
+		'''Seconds until the next ping is due, None without watchdog'''
+		if self.interval is None:
+			return None
+		return max(0, self._next - time.monotonic())
+
+	def ping(self):
+		if self.interval is None:
+			return
+		now = time.monotonic()
+		if now >= self._next:
+			notify('WATCHDOG=1')
+			self._next = now + self.interval
+
+	def close(self):
+		'''No more pings (e.g. after the handover to a new master)'''
+		self.interval = None
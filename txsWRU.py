@@ -0,0 +1,179 @@
+#!/bin/env python3
+"""
+Telex Service - answerback (WRU) of the remote
+
+After WRU (@) the remote sends its answerback, typically framed by CR/LF
+and letter/figure shifts, e.g. '<\r\n12345 abcd d\r\n'. Answerback takes
+the received characters on the protocol side (before they reach the
+_rx_buffer of the provider) from the moment the @ has been sent, and knows the answerback complete at the end of
+line after it. An answerback without end of line is complete WRU_THRES
+seconds after its last character.
+
+Cache keeps the answerbacks of the remotes for a while, a repeated caller
+isn't asked again. The key is only the address of the remote and the
+dialled extension: all callers behind one address (centralex, NAT,
+gateway) share an entry, so it is off unless configured. With a file, all
+processes of the process mode share it.
+"""
+
+import os
+import json
+import threading
+
+import logging
+l = logging.getLogger("txs." + __name__)
+
+
+class Answerback():
+	'''The answerback of the remote, collected from the received characters'''
+
+	def __init__(self, quiet:float):
+		self.text = ''
+		self.shift = None     # last Bu/Zi shift received ('<' or '>')
+		self.done = False
+		self.closed = False
+		self.count = 0        # characters taken
+		self.last = None      # clock time of the last character of the answerback
+		self.on_change = None # called when characters have been taken or it is done (from the protocol side)
+		self.armed = False    # the WRU has been sent, what is received now is the answer
+		self._quiet = quiet
+		self._lf = False      # ended by CR: the LF after it belongs to the answerback, too
+		self._cond = threading.Condition()
+
+	@property
+	def result(self) -> str:
+		return self.text.strip().lower()
+
+	def feed(self, chars:str, now:float) -> str:
+		'''Take the characters of the answerback, returns the ones after it (for the provider)'''
+		with self._cond:
+			if self.done:
+				rest = chars[1:] if self._lf and chars[:1] == '\n' else chars
+				self._lf = False
+				return rest
+			wru = ''   # a WRU of the remote goes on to the provider
+			for i, c in enumerate(chars):
+				if self.done:
+					if self._lf and c == '\n':
+						self._lf = False
+						i += 1
+					break
+				if c in '<>':
+					self.shift = c
+				elif c in '\r\n':
+					# CR/LF in front of the answerback is framing, after it the end
+					if self.text.strip():
+						self.done = True
+						self._lf = c == '\r'
+				elif c == '@':
+					wru += c
+				else:
+					self.text += c
+					self.last = now
+			else:
+				i = len(chars)
+			self.count += i
+			self._cond.notify_all()
+		if self.on_change:
+			self.on_change()
+		return wru + chars[i:]
+
+	def deadline(self, end:float) -> float:
+		'''Clock time when waiting is over: end until the answerback begins, then WRU_THRES after its last character'''
+		return end if self.last is None else self.last + self._quiet
+
+	def finish(self):
+		'''Waiting is over, what has arrived is the answerback'''
+		with self._cond:
+			self.done = True
+
+	def close(self):
+		'''The connection is over'''
+		with self._cond:
+			self.closed = True
+			self._cond.notify_all()
+		if self.on_change:
+			self.on_change()
+
+	def wait(self, clock, timeout:float=None) -> str:
+		'''Wait until the answerback is complete (timeout: clock seconds for its beginning, None: forever)'''
+		end = None if timeout is None else clock.monotonic() + timeout
+		with self._cond:
+			while not self.done and not self.closed:
+				deadline = self.deadline(end)
+				if deadline is None:
+					self._cond.wait()
+					continue
+				wait = deadline - clock.monotonic()
+				if wait <= 0:
+					break
+				self._cond.wait(clock.timeout(wait))
+			self.done = True
+		return self.result
+
+
+class Cache():
+	'''
+	Answerbacks by remote for ttl seconds (wall clock). With path, the
+	entries are kept in a JSON file too.
+	'''
+
+	def __init__(self, ttl:float, path:str=None, size:int=1000):
+		self.ttl = ttl
+		self._path = path
+		self._size = size
+		self._entries = {}   # key -> [answerback, expiry]
+		self._mtime = None   # of the file when it was read or written
+		self._lock = threading.Lock()
+
+	def get(self, key:str, now:float) -> str:
+		'''The answerback of key, None if unknown or expired'''
+		with self._lock:
+			self._load()
+			entry = self._entries.get(key)
+			if entry is None or entry[1] <= now:
+				return None
+			return entry[0]
+
+	def put(self, key:str, answerback:str, now:float):
+		with self._lock:
+			self._load()
+			self._entries[key] = [answerback, now + self.ttl]
+			self._prune(now)
+			self._store()
+
+	def _prune(self, now:float):
+		self._entries = {k: e for k, e in self._entries.items() if e[1] > now}
+		if len(self._entries) > self._size:
+			# the ones expiring first go
+			keep = sorted(self._entries.items(), key=lambda kv: kv[1][1])[-self._size:]
+			self._entries = dict(keep)
+
+	def _load(self):
+		# lock held: read the file again if another process has written it
+		if not self._path:
+			return
+		try:
+			mtime = os.stat(self._path).st_mtime_ns
+			if mtime == self._mtime:
+				return
+			with open(self._path) as f:
+				self._entries = json.load(f)
+			self._mtime = mtime
+		except FileNotFoundError:
+			pass
+		except (OSError, ValueError) as e:
+			l.warning(f"WRU cache {self._path} not readable: {e}")
+
+	def _store(self):
+		# lock held: write a new file and replace the old one (readers never see half of it)
+		if not self._path:
+			return
+		tmp = f"{self._path}.{os.getpid()}"
+		try:
+			with open(tmp, 'w') as f:
+				json.dump(self._entries, f)
+			os.replace(tmp, self._path)
+			self._mtime = os.stat(self._path).st_mtime_ns
+		except OSError as e:
+			l.warning(f"WRU cache {self._path} not writable: {e}")
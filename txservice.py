@@ -4,11 +4,15 @@ Telex Service Server based on piTelex project
 """
 
 import socket
+import selectors
 import multiprocessing
 import signal
 import sys
 import os
 import datetime
+import time
+import heapq
+import collections
 import threading
 
 import logging
@@ -21,6 +25,10 @@ from configparser import ConfigParser
 import importlib
 
 import txServiceProvider_base as txss_base
+import txsPool
+import txsSystemd
+import txsClock
+import txsWRU
 
 LOGLVL = { 'NOTSET' : 0 , 'DEBUG' : 10 , 'INFO' : 20 , 'WARN' : 30 , 'ERROR' : 40 , 'CRITICAL' : 50 }
 
@@ -30,11 +38,21 @@ cfg_defaults = {
 	'server': {
 		'port': 20260,
 		'maxConcurrent': 10, # maximum of concurrent connections
-		'maxWaiting': 2       # maximum number of connections can wait to be handled
+		'maxWaiting': 2,      # maximum number of connections can wait to be handled
+		'listenBacklog': 1024, # connections the kernel keeps until they are accepted (the admission queue does the limiting)
+		'queueTimeout': 30,   # seconds a connection waits for a free slot before it is rejected
+		'queueBanner': 'bitte warten - please wait', # sent to a waiting connection
+		'maxHibernated': 50,  # async mode: sessions parked at a hibernation point (not counted in maxConcurrent)
+		'mode': 'process',    # process: one process per connection, async: all connections on one event loop
+		'poolSize': 0,        # process mode: number of pre-forked warm worker processes (0 = fork on accept)
+		'listenProcesses': 1, # >1: listener processes sharing the port (SO_REUSEPORT), each with its share of the limits
+		'timeScale': 1        # >1: protocol and providers run that much faster than real time (tests, benchmarks)
 	},
 	'provider': {
 		'module': 'txServiceProvider_base', # name of the handler provider module
-		'WRU': '12345 duserv d'             # WRU of this service
+		'WRU': '12345 duserv d',            # WRU of this service
+		'wruCacheTTL': 0,                   # seconds an answerback of a caller is kept (0 = always ask); key: address and extension
+		'wruCacheFile': ''                  # JSON file of the answerbacks (default: txs-wru-cache.json next to this file in process mode, none in async mode)
 	},
 	'logging': {
 		'level': 'INFO'
@@ -42,9 +60,49 @@ cfg_defaults = {
 }
 
 TxSProvider = None
+TxSRoutes = {}   # direct dial extension -> (provider class, WRU), from the [extension …] sections
+TxSServices = [] # ports of the server: the one of [server]/[provider] first, then the [service …] sections
+
+def load_provider(module:str):
+	'''Import a provider module and return its provider class'''
+	mod = importlib.import_module(module)
+	if module == 'txServiceProvider_base':
+		return mod.TelexServiceProvider_base
+	return mod.TelexServiceProvider
+
+def new_provider(ext=None, service=None):
+	'''Provider for the dialled extension ext, else the one of the service (default: [provider])'''
+	if ext in TxSRoutes:
+		cls, wru = TxSRoutes[ext]
+		txss = cls()
+		txss.WRU = wru
+		txss._extension = ext
+		return txss
+	return (service or TxSServices[0]).new_provider()
+
+def route_provider(txss, conn, service:str=None):
+	'''
+	Child side of the routing: wait for the Direct Dial packet of the caller
+	and replace the (pre-created) default provider if the extension belongs
+	to another service, or if the connection came in on the port of another
+	service (name, pool workers only know this after the handoff).
+	'''
+	routed = None
+	if TxSRoutes:
+		ext = txss_base.peek_direct_dial(conn, txss_base.DIAL_TIMEOUT, txss._received)
+		if ext in TxSRoutes:
+			routed = new_provider(ext)
+			l.info(f"Extension {ext} routed to {type(routed).__module__}")
+	if routed is None and service:
+		routed = new_provider(None, next(svc for svc in TxSServices if svc.name == service))
+	if routed is None:
+		return txss
+	routed._sent_offset = txss._sent_offset
+	routed._received = txss._received
+	return routed
 
 def init():
-	global config,cfg_defaults,configFile,TxSProvider
+	global config,cfg_defaults,configFile,TxSProvider,TxSRoutes,TxSServices
 	parser = ArgumentParser(prog='txservice',description='Provides an service to the i-telex network.',epilog='More infos at https://github.com/coffeinator/TelexService.git')
 	parser.add_argument("-c", "--config",
 	    dest="cfg_file", default='txservice.conf', metavar="FILE",
@@ -61,6 +119,18 @@ def init():
 	parser.add_argument("-m", "--module",
 	    dest="module", metavar="MODULE",
 	    help="Python module with provider")
+	parser.add_argument("--mode",
+	    dest="mode", metavar="MODE", choices=['process','async'],
+	    help="Server mode (process, async)")
+	parser.add_argument("--pool",
+	    dest="pool", metavar="SIZE",
+	    help="Number of pre-forked worker processes (0 = none)")
+	parser.add_argument("--listeners",
+	    dest="listeners", metavar="K",
+	    help="Number of listener processes sharing the port (SO_REUSEPORT)")
+	parser.add_argument("--time-scale",
+	    dest="time_scale", metavar="FACTOR",
+	    help="Run protocol and providers FACTOR times faster than real time")
 	parser.add_argument("-l", "--loglevel",
 	    dest="loglvl", metavar="LEVEL",
 	    help="Log level (DEBUG, INFO, WARN, ERROR, CRITICAL)")
@@ -86,17 +156,55 @@ def init():
 	if args.module   is not None: config['provider']['module']      = args.module
 	if args.wru      is not None: config['provider']['WRU']         = args.wru
 	if args.loglvl   is not None: config['logging']['level']        = args.loglvl
+	if args.mode     is not None: config['server']['mode']          = args.mode
+	if args.pool     is not None: config['server']['poolSize']      = args.pool
+	if args.listeners is not None: config['server']['listenProcesses'] = args.listeners
+	if args.time_scale is not None: config['server']['timeScale'] = args.time_scale
 	
 	
 	# logging
 	init_error_log("./",10,"DEBUG")
 	
 	# import specified provider
-	mod = importlib.import_module(config['provider']['module'])
-	if config['provider']['module'] == 'txServiceProvider_base':
-		TxSProvider = mod.TelexServiceProvider_base
-	else:
-		TxSProvider = mod.TelexServiceProvider
+	TxSProvider = load_provider(config['provider']['module'])
+
+	# simulated time for all providers (see txsClock)
+	scale = float(config['server']['timeScale'])
+	if scale != 1:
+		txss_base.TelexServiceProvider_base.clock = txsClock.ScaledClock(scale)
+		print(f'Time runs {scale:g} times faster than real time')
+
+	# answerbacks of the callers; the processes of the process mode share them through the file
+	ttl = float(config['provider']['wruCacheTTL'])
+	if ttl > 0:
+		path = config['provider']['wruCacheFile']
+		if not path and config['server']['mode'] != 'async':
+			path = os.path.join(OUR_PATH, 'txs-wru-cache.json')
+		txss_base.TelexServiceProvider_base.wruCache = txsWRU.Cache(ttl, path or None)
+
+	# further services behind the same port, chosen by the dialled extension
+	# (all modules are imported here, so forked children and workers are warm for all of them)
+	for section in config.sections():
+		if not section.startswith('extension '):
+			continue
+		ext = section.split(None, 1)[1].strip()
+		if ext in ('0', ''):
+			print(f'Error in config-file: extension {ext!r} is served by [provider].')
+			raise ValueError(section)
+		TxSRoutes[ext] = (load_provider(config[section]['module']),
+			config[section].get('WRU', config['provider']['WRU']))
+
+	# further ports, each with its own service, all sharing [server] maxConcurrent
+	TxSServices = [Service('', int(config['server']['port']), TxSProvider, config['provider']['WRU'])]
+	for section in config.sections():
+		if not section.startswith('service '):
+			continue
+		sect = config[section]
+		maxConcurrent = sect.get('maxConcurrent', None)
+		TxSServices.append(Service(section.split(None, 1)[1].strip(), int(sect['port']),
+			load_provider(sect.get('module', config['provider']['module'])),
+			sect.get('WRU', config['provider']['WRU']),
+			int(maxConcurrent) if maxConcurrent else None))
 
 
 '''
@@ -218,13 +326,444 @@ def threading_excepthook(args):
 ##### SERVER #####
 '''
 
+class Service():
+	"""
+	A port of the server with its provider and WRU. maxConcurrent limits the
+	connections of this service within the budget of [server] maxConcurrent,
+	which all services share (None: only the shared budget).
+	"""
+	def __init__(self, name:str, port:int, providerClass, WRU:str, maxConcurrent:int=None):
+		self.name = name
+		self.port = port
+		self.providerClass = providerClass
+		self.WRU = WRU
+		self.maxConcurrent = maxConcurrent
+		self.active = 0
+		self.sock = None
+
+	def __str__(self):
+		return f"{self.name or 'default'} (port {self.port}, {self.providerClass.__module__})"
+
+	def available(self) -> bool:
+		return self.maxConcurrent is None or self.active < self.maxConcurrent
+
+	def new_provider(self):
+		txss = self.providerClass()
+		txss.WRU = self.WRU
+		return txss
+
+
+class SlotLedger():
+	"""
+	Authoritative pid -> slot ledger of the master (process mode).
+	A slot is taken when a child gets a connection and freed when the master
+	reaps the child, no matter how it has ended (even if killed or crashed).
+	"""
+	def __init__(self, size:int):
+		self._free = list(range(size))   # heap of free slot numbers
+		self._slots = {}                 # pid -> slot
+		self.reclaimed = 0               # slots of children that ended abnormally
+
+	def available(self) -> int:
+		return len(self._free)
+
+	def active(self) -> int:
+		return len(self._slots)
+
+	def pids(self) -> list:
+		return list(self._slots)
+
+	def take(self, pid:int) -> int:
+		slot = heapq.heappop(self._free)
+		self._slots[pid] = slot
+		return slot
+
+	def release(self, pid:int, status:int) -> bool:
+		'''Free the slot of a reaped child, returns False if pid had no slot'''
+		slot = self._slots.pop(pid, None)
+		if slot is None:
+			return False
+		heapq.heappush(self._free, slot)
+		exitcode = os.waitstatus_to_exitcode(status)
+		if exitcode != 0:
+			# the child could not clean up by itself (killed, crashed, …)
+			self.reclaimed += 1
+			l.warning(f"Child {pid} ended with {exitcode}, slot {slot} reclaimed ({self.reclaimed} reclaimed so far)")
+		return True
+
+
+class AdmissionQueue():
+	"""
+	FIFO of accepted connections which wait for a free slot (process mode).
+	A waiting caller gets a short banner and the i-Telex link is kept alive
+	with Acknowledge packets, until a slot is free or its deadline has passed
+	(then it gets "occ" like before).
+	"""
+	ACK_INTERVAL = 1.0
+
+	def __init__(self, size:int, timeout:float, banner:str, sel):
+		self._size = size
+		self._timeout = timeout
+		self._sel = sel
+		self._banner, self._banner_len = txss_base.encode_baudot_packets(banner) if banner else (b'', 0)
+		self._q = collections.deque()   # [conn, addr, time enqueued, time of next ack, service, received]
+		# metrics
+		self.max_depth = 0
+		self.served = 0
+		self.timeouts = 0
+		self.abandoned = 0
+		self.overflows = 0
+		self.wait_total = 0.0
+		self.wait_max = 0.0
+
+	def __len__(self):
+		return len(self._q)
+
+	def push(self, conn, addr, service=None) -> bool:
+		'''Let conn wait, returns False if the queue is full'''
+		if len(self._q) >= self._size:
+			return False
+		now = time.monotonic()
+		entry = [conn, addr, now, now + self.ACK_INTERVAL, service, bytearray()]
+		try:
+			conn.sendall(self._banner + bytes([6, 1, 0]))   # banner and Acknowledge (nothing printed)
+		except OSError:
+			self._drop(entry)
+			return True
+		self._q.append(entry)
+		self.max_depth = max(self.max_depth, len(self._q))
+		# watch for the caller hanging up while waiting
+		self._sel.register(conn, selectors.EVENT_READ, self)
+		l.info(f"Connection from {addr} queued ({len(self._q)} waiting)")
+		return True
+
+	def waiting(self, admissible) -> bool:
+		'''Is a connection waiting which admissible(service) would admit?'''
+		return any(admissible(entry[4]) for entry in self._q)
+
+	def pop(self, admissible):
+		'''
+		Remove the longest waiting connection which admissible(service) admits,
+		returns conn, addr, the count of Baudot characters sent to it, its
+		service and what it has sent, None if there is none
+		'''
+		for entry in self._q:
+			if admissible(entry[4]):
+				break
+		else:
+			return None
+		self._q.remove(entry)
+		conn, addr, t_enq, t_ack, service, received = entry
+		self._unwatch(conn)
+		wait = time.monotonic() - t_enq
+		self.served += 1
+		self.wait_total += wait
+		self.wait_max = max(self.wait_max, wait)
+		l.info(f"Connection from {addr} admitted after waiting {wait:.1f} s")
+		return conn, addr, self._banner_len, service, bytes(received)
+
+	def readable(self, conn):
+		'''
+		The selector reports data or EOF of a waiting connection: the data is
+		kept for the provider (so a hang-up is noticed after it, too)
+		'''
+		entry = next((entry for entry in self._q if entry[0] is conn), None)
+		if entry is None:
+			return
+		try:
+			data = conn.recv(txss_base.WAIT_RECEIVE)
+		except OSError:
+			data = b''
+		if not data:
+			self._q.remove(entry)
+			self.abandoned += 1
+			l.info(f"Waiting connection from {entry[1]} hung up")
+			self._drop(entry)
+			return
+		entry[5] += data
+		if len(entry[5]) > txss_base.WAIT_RECEIVE:
+			# a caller which sends that much while waiting isn't a teleprinter
+			self._q.remove(entry)
+			self.overflows += 1
+			l.warning(f"Rejected connection from {entry[1]}: sent more than {txss_base.WAIT_RECEIVE} bytes while waiting")
+			try:
+				txss_base.TelexServiceProvider_base.send_reject(conn, "occ")
+			except OSError:
+				pass
+			self._drop(entry)
+
+	def service(self):
+		'''Send the keep-alive Acknowledges which are due and reject expired connections'''
+		now = time.monotonic()
+		for entry in list(self._q):
+			conn, addr, t_enq, t_ack, service, received = entry
+			if now - t_enq >= self._timeout:
+				self._q.remove(entry)
+				self.timeouts += 1
+				l.warning(f"Rejected connection from {addr}: no free slot within {self._timeout} s")
+				try:
+					txss_base.TelexServiceProvider_base.send_reject(conn, "occ")
+				except OSError:
+					pass
+				self._drop(entry)
+			elif now >= t_ack:
+				entry[3] = t_ack + self.ACK_INTERVAL
+				try:
+					conn.sendall(bytes([6, 1, 0]))
+				except OSError:
+					self._q.remove(entry)
+					self.abandoned += 1
+					self._drop(entry)
+
+	def next_timeout(self):
+		'''Seconds until service() has work to do, None if nobody is waiting'''
+		if not self._q:
+			return None
+		t = min(min(entry[2] + self._timeout, entry[3]) for entry in self._q)
+		return max(0, t - time.monotonic())
+
+	def close(self):
+		while self._q:
+			self._drop(self._q.popleft())
+
+	def forget(self):
+		'''
+		In a forked child: close its copies of the waiting connections, the
+		master still serves them (the selector is shared, so no unregister)
+		'''
+		for entry in self._q:
+			try:
+				entry[0].close()
+			except Exception:
+				pass
+		self._q.clear()
+
+	def stats(self) -> str:
+		avg = self.wait_total / self.served if self.served else 0
+		return (f"queue: {len(self._q)} waiting (max {self.max_depth}), {self.served} served "
+			f"(wait avg {avg:.1f} s, max {self.wait_max:.1f} s), {self.timeouts} timed out, {self.abandoned} hung up, "
+			f"{self.overflows} sent too much")
+
+	def _unwatch(self, conn):
+		try:
+			self._sel.unregister(conn)
+		except (KeyError, ValueError):
+			pass
+
+	def _drop(self, entry):
+		self._unwatch(entry[0])
+		try:
+			entry[0].close()
+		except Exception:
+			pass
+
+
 def main():
+	# K independent listener processes on the same port, the kernel balances the calls
+	if int(config['server']['listenProcesses']) > 1:
+		supervise_listeners(int(config['server']['listenProcesses']))
+	else:
+		serve()
+
+def share(total:int, k:int, i:int) -> int:
+	'''
+	Share of listener i (of k) on total, at least 1 unless total is 0 (off):
+	the kernel sends calls to every listener, one with nothing could only
+	reject them
+	'''
+	if total <= 0:
+		return 0
+	return max(1, total // k + (1 if i < total % k else 0))
+
+def supervise_listeners(k:int):
+	"""
+	Start k listener processes, each binds the port with SO_REUSEPORT and
+	serves its own share of maxConcurrent, maxWaiting, maxHibernated and
+	poolSize with its own children (at least 1 of each one which isn't 0,
+	so for a small one the total is a little more than configured). The supervisor only forwards signals and
+	restarts a listener which has died.
+	The supervisor binds the sockets of the listeners itself and keeps them:
+	closing a SO_REUSEPORT socket resets the calls in its accept queue, so a
+	restarted listener and the listeners of the successor take over the
+	same sockets.
+	SIGHUP: start a new supervisor with our sockets, then let our listeners
+	serve their connections to the end.
+	"""
+	maxConcurrent = int(config['server']['maxConcurrent'])
+	if k > maxConcurrent:
+		l.warning(f"More listener processes ({k}) than maxConcurrent ({maxConcurrent}), using {maxConcurrent}")
+		k = maxConcurrent
+
+	sigs = {signal.SIGINT, signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2, signal.SIGCHLD, signal.SIGHUP}
+	signal.pthread_sigmask(signal.SIG_BLOCK, sigs)
+
+	# listening sockets inherited from systemd or the previous master are shared by
+	# all listeners, else every listener gets its own SO_REUSEPORT sockets
+	# (inherited from the previous supervisor or bound here)
+	fds = os.environ.pop('TXS_LISTEN_FD', None)
+	if fds is not None:
+		socks = [socket.socket(fileno=int(fd)) for fd in fds.split(',')]
+	else:
+		socks = txsSystemd.listen_fds()
+	if socks:
+		groups = [socks] * k
+	else:
+		fds = os.environ.pop('TXS_LISTENER_FDS', None)
+		groups = [[socket.socket(fileno=int(fd)) for fd in group.split(',')] for group in fds.split(';')] if fds else []
+		for group in groups[k:]:
+			l.warning(f"Listening sockets {[sock.getsockname() for sock in group]} of a listener which isn't started anymore, closed")
+			for sock in group:
+				sock.close()
+		del groups[k:]
+		while len(groups) < k:
+			groups.append([bind_socket(svc.port, reusePort=True) for svc in TxSServices])
+	watchdog = txsSystemd.Watchdog()
+
+	listeners = {}   # pid -> index
+	restarts = []    # [(time, index)] listeners to be restarted
+	started = {}     # index -> time of the last start
+
+	def _start(i):
+		started[i] = time.monotonic()
+		pid = txsPool.fork_child(listener_main, i, k, groups)
+		listeners[pid] = i
+		l.info(f"Listener {i} started (pid {pid})")
+
+	for i in range(k):
+		_start(i)
+	l.info(f"Supervising {k} listener processes on port {config['server']['port']}")
+	txsSystemd.notify(f"READY=1\nSTATUS=Supervising {k} listener processes")
+
+	stopping = False
+	while listeners:
+		timeouts = [t for t in (watchdog.timeout(),) if t is not None]
+		if restarts:
+			timeouts.append(max(0, min(t for t, i in restarts) - time.monotonic()))
+		info = signal.sigtimedwait(sigs, min(timeouts)) if timeouts else signal.sigwaitinfo(sigs)
+		watchdog.ping()
+
+		if info is not None and info.si_signo in (signal.SIGINT, signal.SIGTERM):
+			if not stopping:
+				l.info("Signal received, shutting down listeners...")
+				txsSystemd.notify("STOPPING=1")
+				stopping = True
+				restarts = []
+				for pid in listeners:
+					os.kill(pid, signal.SIGTERM)
+		elif info is not None and info.si_signo == signal.SIGHUP:
+			if not stopping:
+				pid = txsPool.spawn_successor(socks, None if socks else groups)
+				l.info(f"SIGHUP: new supervisor {pid} started, listeners are finishing their connections")
+				txsSystemd.notify(f"MAINPID={pid}")
+				watchdog.close()
+				stopping = True
+				restarts = []
+				for pid in listeners:
+					os.kill(pid, signal.SIGHUP)
+				# the new supervisor has them now
+				for sock in (sock for group in groups for sock in group):
+					sock.close()
+		elif info is not None and info.si_signo in (signal.SIGUSR1, signal.SIGUSR2):
+			for pid in listeners:
+				os.kill(pid, info.si_signo)
+
+		# reap ended listeners and restart them (not faster than once a second)
+		while True:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except ChildProcessError:
+				break
+			if pid == 0:
+				break
+			i = listeners.pop(pid, None)
+			if i is None or stopping:
+				continue
+			l.error(f"Listener {i} (pid {pid}) ended with {os.waitstatus_to_exitcode(status)}, restarting")
+			restarts.append((started[i] + 1.0, i))
+
+		now = time.monotonic()
+		for t, i in list(restarts):
+			if t <= now:
+				restarts.remove((t, i))
+				_start(i)
+
+	print("All listeners ended.")
+
+def listener_main(i:int, k:int, groups:list):
+	signal.pthread_sigmask(signal.SIG_SETMASK, [])
+	txsSystemd.detach()   # the supervisor talks to systemd
+	# our sockets, the ones of the other listeners only the supervisor keeps
+	os.environ['TXS_LISTEN_FD'] = ','.join(str(sock.fileno()) for sock in groups[i])
+	for group in groups:
+		if group is not groups[i]:
+			for sock in group:
+				sock.close()
+	# this process' share
+	for key in ('maxConcurrent', 'maxWaiting', 'maxHibernated', 'poolSize'):
+		config['server'][key] = str(share(int(config['server'][key]), k, i))
+	for svc in TxSServices:
+		if svc.maxConcurrent is not None:
+			svc.maxConcurrent = share(svc.maxConcurrent, k, i)
+	serve(reusePort=True, successor=False)
+
+def listen_sockets(reusePort=False):
+	'''
+	Set the listening socket of every service: inherited from the previous
+	master (SIGHUP) or the supervisor, passed by systemd (in the order of the
+	services) or newly bound
+	'''
+	fds = os.environ.pop('TXS_LISTEN_FD', None)
+	if fds is not None:
+		socks = [socket.socket(fileno=int(fd)) for fd in fds.split(',')]
+		l.info(f"Listening sockets (fd {fds}) inherited from the previous master or the supervisor")
+	else:
+		socks = txsSystemd.listen_fds()
+		if socks:
+			l.info(f"{len(socks)} listening sockets passed by systemd, their ports are used instead of the config file")
+	for sock in socks[len(TxSServices):]:
+		l.warning(f"Listening socket {sock.getsockname()} has no service, closed")
+		sock.close()
+
+	for i, svc in enumerate(TxSServices):
+		if i < len(socks):
+			svc.sock = socks[i]
+			continue
+		svc.sock = bind_socket(svc.port, reusePort)
+
+def bind_socket(port:int, reusePort=False) -> socket.socket:
+	'''A new listening socket on port (SO_REUSEPORT: next to others on the same port)'''
+	server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if reusePort:
+		server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	server_sock.bind(('0.0.0.0', port))
+	server_sock.listen(int(config['server']['listenBacklog']))
+	return server_sock
+
+def serve(reusePort=False, successor=True):
+	'''
+	Accept and serve connections until SIGINT/SIGTERM.
+	SIGHUP: start a successor (if successor) which takes over the listening
+	sockets, then serve the active connections to their end and exit.
+	'''
+	listen_sockets(reusePort)
+
+	# all connections in one process on an asyncio event loop
+	if config['server']['mode'] == 'async':
+		import txsAsync
+		txsAsync.main(config, new_provider, TxSServices, successor, bool(TxSRoutes))
+		return
+
 	# Graceful shutdown bei SIGINT/SIGTERM
 	stop = multiprocessing.Event()
 	acceptNew = True
-	children = []
-	# Semaphore zur Begrenzung paralleler Prozesse
-	sema = multiprocessing.Semaphore(int(config['server']['maxConcurrent']))
+	# Buchführung der belegten Plätze (pid -> Platz) zur Begrenzung paralleler Prozesse
+	ledger = SlotLedger(int(config['server']['maxConcurrent']))
+	pool = None
+	queue = None
+	hup = False        # SIGHUP received
+	handover = False   # listening sockets given up, only the active connections are served
+	owners = {}        # pid -> service of the connection
 
 	# stops all active connections and comes to an end
 	def _signal_handler_term(signum, frame):
@@ -232,84 +771,249 @@ def main():
 		stop.set()
 	# get count of currently connected connections
 	def _signal_handler_getconn(signum, frame):
-		l.info(str(int(config['server']['maxConcurrent']) - sema.get_value()) + " Currently Active Connections <---------------------------------------")
-		print(int(config['server']['maxConcurrent']) - sema.get_value())
+		l.info(str(ledger.active()) + " Currently Active Connections <---------------------------------------")
+		l.info(str(ledger.reclaimed) + " Slots reclaimed from abnormally ended children")
+		print(ledger.active(), ledger.reclaimed)
+		if len(TxSServices) > 1:
+			services = ", ".join(f"{svc.name or 'default'}: {svc.active}" for svc in TxSServices)
+			l.info("Active connections per service: " + services)
+			print(services)
+		if queue is not None:
+			l.info(queue.stats())
+			print(queue.stats())
 	# stop accepting new connection, so we can give active connections a chance
 	# to get finished without be ended while do long requests
 	def _signal_handler_stopaccept(signum, frame):
 		l.info("Signal received, dont accept anymore...")
 		nonlocal acceptNew
 		acceptNew = False
+	# a child has ended; it is reaped in the loop, the signal only wakes it up
+	def _signal_handler_child(signum, frame):
+		pass
+	# hand the listening socket over to a new master, handled in the loop
+	def _signal_handler_hup(signum, frame):
+		nonlocal hup
+		hup = True
+
+	# Self-Pipe: jedes Signal schreibt hierhin und weckt damit select() sofort auf
+	wakeup_r, wakeup_w = socket.socketpair()
+	wakeup_r.setblocking(False)
+	wakeup_w.setblocking(False)
+	signal.set_wakeup_fd(wakeup_w.fileno(), warn_on_full_buffer=False)
 
 	signal.signal(signal.SIGINT, _signal_handler_term)
 	signal.signal(signal.SIGTERM, _signal_handler_term)
 	signal.signal(signal.SIGUSR1, _signal_handler_getconn)     # USR1 - Get current connection count
 	signal.signal(signal.SIGUSR2, _signal_handler_stopaccept)  # USR2 - Stop accepting new connections
+	signal.signal(signal.SIGCHLD, _signal_handler_child)       # CHLD - a child has ended
+	signal.signal(signal.SIGHUP, _signal_handler_hup)          # HUP  - Restart without dropping calls
 
+	def _reap_children() -> list:
+		# alle beendeten Kinder abholen, egal wie sie beendet wurden
+		reaped = []
+		while True:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except ChildProcessError:
+				break
+			if pid == 0:
+				break
+			reaped.append(pid)
+			if ledger.release(pid, status):
+				owners.pop(pid).active -= 1
+			elif not (pool is not None and pool.reaped(pid)):
+				l.debug(f"Reaped child {pid}")
+		return reaped
+
+
+	with selectors.DefaultSelector() as sel:
+		for svc in TxSServices:
+			svc.sock.setblocking(False)
+			sel.register(svc.sock, selectors.EVENT_READ, svc)
+			l.info(f"Server listening on port {svc.sock.getsockname()[1]} for service {svc}")
+		l.info(f"max {config['server']['maxConcurrent']} concurrent handlers")
+		sel.register(wakeup_r, selectors.EVENT_READ)
+
+		# Warteschlange für Verbindungen, die (noch) keinen freien Platz haben
+		queue = AdmissionQueue(int(config['server']['maxWaiting']), float(config['server']['queueTimeout']),
+			config['server']['queueBanner'], sel)
+
+		# warm workers, which are waiting for a connection
+		if int(config['server']['poolSize']) > 0:
+			pool = txsPool.WorkerPool(int(config['server']['poolSize']), new_provider, stop, lambda: child_init(queue), route_provider)
+			pool.fill()
+			l.info(f"Pool of {config['server']['poolSize']} pre-forked workers started")
+
+		def _admissible(svc) -> bool:
+			# gemeinsames Budget und Grenze des Dienstes
+			return ledger.available() and svc.available()
+
+		def _handle_conn(conn, addr, svc):
+			# Freien Platz belegen; wenn nicht sofort möglich, in die Warteschlange, sonst lehnen wir ab
+			if acceptNew and _admissible(svc) and not queue.waiting(_admissible):
+				_start_session(conn, addr, 0, svc)
+				return
+			if acceptNew and queue.push(conn, addr, svc):
+				return
+
+			# Keine Kapazität: schließen und optional kurze Nachricht senden
+			try:
+				txss_base.TelexServiceProvider_base.send_reject(conn, "occ")
+				conn.close()
+			except:
+				pass
+			l.warning(f"Rejected connection from {addr}: max concurrent reached")
+
+		def _start_session(conn, addr, sent, svc, received=b''):
+			# Verbindung an einen wartenden Worker übergeben, sonst neuen Prozess starten
+			pid = pool.handoff(conn, addr, sent, svc.name, received) if pool is not None else None
+			if pid is None:
+				txss = new_provider(None, svc)
+				txss._sent_offset = sent
+				txss._received = received
+				pid = txsPool.fork_child(child_main, txss, conn, addr, stop, queue)
+			ledger.take(pid)
+			owners[pid] = svc
+			svc.active += 1
+
+			# Schließe die Server-Seite des Sockets im Elternprozess, damit fd richtig verwaltet wird
+			try:
+				conn.close()
+			except Exception:
+				pass
 
-	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_sock:
-		server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-		server_sock.bind(('0.0.0.0', int(config['server']['port'])))
-		server_sock.listen(int(config['server']['maxWaiting']))
-		server_sock.settimeout(2.0)  # Periodisch prüfen, ob gestoppt werden soll
-		l.info(f"Server listening on port {config['server']['port']}, max {config['server']['maxConcurrent']} concurrent handlers")
+		# systemd: bereit, und Lebenszeichen für den Watchdog aus der Schleife
+		watchdog = txsSystemd.Watchdog()
+		txsSystemd.notify(f"READY=1\nSTATUS=Listening on port {', '.join(str(svc.sock.getsockname()[1]) for svc in TxSServices)}")
 
 		try:
-			while not stop.is_set():
-				try:
-					conn, addr = server_sock.accept()
-				except ConnectionAbortedError:
-					l.info("Exception caught:", exc_info = sys.exc_info())
-					continue
-				except (socket.timeout, OSError):
-					continue
-
-				# Versuchen, Semaphore zu kaufen; wenn nicht sofort möglich, lehnen wir ab
-				if not acceptNew or not sema.acquire(block=False):
-					# Keine Kapazität: schließen und optional kurze Nachricht senden
-					try:
-						txss_base.TelexServiceProvider_base.send_reject(conn, "occ")
-						conn.close()
-					except:
-						pass
-					l.warning(f"Rejected connection from {addr}: max concurrent reached")
-					continue
-
-				else:
-					txss = TxSProvider()
-					txss.WRU = config['provider']['WRU']
-					# Startprozess: übergibt sema (Semaphore ist ein Synchronisationsobjekt)
-					p = multiprocessing.Process(target=txss.handle_client, args=(conn, addr, sema, stop), daemon=True)
-					p.start()
-					children.append(p)
-
-					# Schließe die Server-Seite des Sockets im Elternprozess, damit fd richtig verwaltet wird
-					try:
-						conn.close()
-					except Exception:
-						pass
+			# nach der Übergabe (SIGHUP) nur noch bis alle aktiven und wartenden Verbindungen beendet sind
+			while not stop.is_set() and not (handover and not ledger.active() and not len(queue)):
+				# Warten bis eine Verbindung ansteht oder ein Signal kommt, im Leerlauf
+				# ohne Timeout (außer es warten Verbindungen in der Warteschlange oder der Watchdog will gefüttert werden)
+				timeouts = [t for t in (queue.next_timeout(), watchdog.timeout(), pool.timeout() if pool is not None else None) if t is not None]
+				for key, mask in sel.select(min(timeouts) if timeouts else None):
+					if key.data is queue:
+						queue.readable(key.fileobj)
+						continue
+					if key.fileobj is wakeup_r:
+						try:
+							while wakeup_r.recv(64):
+								pass
+						except BlockingIOError:
+							pass
+						continue
+
+					# alle anstehenden Verbindungen des Dienstes annehmen
+					svc = key.data
+					while not stop.is_set():
+						try:
+							conn, addr = svc.sock.accept()
+						except BlockingIOError:
+							break
+						except ConnectionAbortedError:
+							l.info("Exception caught:", exc_info = sys.exc_info())
+							continue
+						except OSError:
+							l.error("Exception caught:", exc_info = sys.exc_info())
+							break
+						conn.setblocking(True)
+						_handle_conn(conn, addr, svc)
 
 				# Aufräumen beendeter Kind-Prozesse
-				alive = []
-				for c in children:
-					if c.is_alive():
-						alive.append(c)
-					else:
-						c.join(timeout=0)
-				children = alive
+				_reap_children()
+				watchdog.ping()
+
+				# Übergabe: der neue Master nimmt ab jetzt die Verbindungen an,
+				# wir bedienen nur noch unsere aktiven und wartenden Anrufer
+				if hup and not handover:
+					handover = True
+					acceptNew = False
+					if successor:
+						pid = txsPool.spawn_successor([svc.sock for svc in TxSServices])
+						l.info(f"SIGHUP: new master {pid} takes over the listening sockets, serving {ledger.active()} active connections to their end")
+						txsSystemd.notify(f"MAINPID={pid}")
+						watchdog.close()
+					for svc in TxSServices:
+						sel.unregister(svc.sock)
+						svc.sock.close()
+					if pool is not None:
+						pool.close()   # idle workers exit and are reaped as unknown children
+						pool = None
+
+				# freie Plätze an die am längsten Wartenden vergeben
+				while True:
+					entry = queue.pop(_admissible)
+					if entry is None:
+						break
+					_start_session(*entry)
+				queue.service()
+
+				# Pool wieder auffüllen, ein Worker pro Durchlauf (der Anrufer hat seinen
+				# Worker schon, anstehende Verbindungen werden zwischendurch angenommen)
+				if pool is not None: pool.fill(1)
 
 		finally:
 			print("Closing server socket and terminating children...")
-			try:
-				server_sock.close()
-			except Exception:
-				pass
-			# Signal an Kinder: hier beenden wir sie freundlich, dann hart
-			for c in children:
-				if c.is_alive():
-					c.terminate()
-			for c in children:
-				c.join(timeout=1)
+			if not handover:
+				txsSystemd.notify("STOPPING=1")
+			stop.set()
+			if queue is not None: queue.close()
+			for svc in TxSServices:
+				try:
+					svc.sock.close()
+				except Exception:
+					pass
+			remaining = set(ledger.pids())
+			if pool is not None: remaining.update(pool.close())
+			# Kinder beenden: zuerst freundlich (stop ist gesetzt), dann hart
+			terminate_children(remaining, _reap_children)
+			signal.set_wakeup_fd(-1)
+			wakeup_r.close()
+			wakeup_w.close()
+
+def terminate_children(pids:set, reap, timeout=1.0):
+	"""
+	Wait up to timeout for the children to end by themselves, then send
+	SIGTERM to the remaining ones and wait again.
+	"""
+	for sig in (None, signal.SIGTERM):
+		if sig:
+			for pid in pids:
+				try:
+					os.kill(pid, sig)
+				except ProcessLookupError:
+					pass
+		t_end = time.monotonic() + timeout
+		while pids and time.monotonic() < t_end:
+			pids.difference_update(reap())
+			if pids:
+				time.sleep(0.05)
+		if not pids:
+			return
+
+def child_init(queue=None):
+	"""
+	Reset what a child process has inherited from the master loop: Signals of
+	the child must neither wake up nor stop the master. A child is stopped by
+	the stop event (friendly) or by SIGTERM (hard). The connections waiting in
+	the admission queue belong to the master, their hangup must not depend on
+	the child.
+	"""
+	signal.set_wakeup_fd(-1)
+	signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	signal.signal(signal.SIGINT,  signal.SIG_IGN)
+	signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+	signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+	signal.signal(signal.SIGHUP,  signal.SIG_IGN)
+	if queue is not None:
+		queue.forget()
+
+def child_main(txss, conn, addr, stop, queue=None):
+	child_init(queue)
+	txss = route_provider(txss, conn)
+	txss.handle_client(conn, addr, None, stop)
 
 if __name__ == "__main__":
 	init()